@@ -4,63 +4,164 @@
 from fastapi import HTTPException, Depends, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy import text
-from datetime import datetime, timedelta
-from typing import Optional, Dict, List
+from sqlalchemy.ext.asyncio import AsyncSession
+from cachetools import TTLCache
+from typing import Optional, Dict, List, AsyncIterator
+from contextlib import asynccontextmanager
 import jwt
+import bcrypt
+import asyncio
 import hashlib
+import hmac
 import secrets
 import logging
+import time
 
 from .database import get_database
-from .tenant_middleware import get_tenant_id
+from .jwt_codec import OrjsonJWT, JWT_DECODE_OPTIONS
+from .tenant_middleware import (
+    get_tenant_id, get_db, hash_api_key, legacy_api_key_hash, upgrade_legacy_api_key_hash,
+    invalidate_cached_api_key, api_key_usage
+)
 
 logger = logging.getLogger(__name__)
 
 # Security scheme
 security = HTTPBearer()
 
+@asynccontextmanager
+async def _use_session(db: Optional[AsyncSession]) -> AsyncIterator[AsyncSession]:
+    """Reuse the request session when given, otherwise open a new one"""
+    if db is not None:
+        yield db
+    else:
+        async with get_database() as session:
+            yield session
+
+# bcrypt hash (cost 12, matching bcrypt_rounds) of a random throwaway password,
+# checked for unknown emails so login timing doesn't reveal which accounts exist
+_DUMMY_PASSWORD_HASH = b"$2b$12$vaiFgAMD3e4jnZJ3unpf2.cP4L/5./TaIj/UfaAZXNKNgEmTbbNfm"
+
+# SQL statements (built once, reused on every call)
+_VERIFY_API_KEY_SQL = text("""
+    SELECT 
+        k.tenant_id, k.store_id, k.key_id, k.key_hash,
+        t.company_name, t.is_active as tenant_active,
+        s.store_name, s.is_active as store_active,
+        set_config('app.tenant_id', k.tenant_id, true) as tenant_context
+    FROM store_api_keys k
+    JOIN tenants t ON k.tenant_id = t.tenant_id
+    JOIN stores s ON k.tenant_id = s.tenant_id AND k.store_id = s.store_id
+    WHERE k.key_hash IN (:key_hash, :legacy_key_hash)
+    AND k.is_active = TRUE
+""")
+_SET_TENANT_CONTEXT_SQL = text("SELECT set_config('app.tenant_id', :tenant_id, true)")
+_INSERT_DASHBOARD_USER_SQL = text("""
+    INSERT INTO dashboard_users (
+        user_id, tenant_id, email, password_hash, user_type, permissions, created_at
+    ) VALUES (
+        :user_id, :tenant_id, :email, :password_hash, :user_type, :permissions, NOW()
+    )
+    ON CONFLICT (email, tenant_id) DO NOTHING
+    RETURNING user_id
+""")
+_AUTHENTICATE_USER_SQL = text("""
+    SELECT 
+        u.user_id, u.tenant_id, u.email, u.user_type, u.permissions,
+        u.password_hash, u.password_change_required, u.last_login_at,
+        t.company_name, t.is_active as tenant_active
+    FROM dashboard_users u
+    JOIN tenants t ON u.tenant_id = t.tenant_id
+    WHERE u.email = :email 
+    AND u.is_active = TRUE
+""")
+_UPDATE_LAST_LOGIN_SQL = text("""
+    UPDATE dashboard_users
+    SET last_login_at = NOW(), password_hash = COALESCE(:password_hash, password_hash)
+    WHERE user_id = :user_id
+""")
+_TENANT_ACTIVE_SQL = text("SELECT is_active FROM tenants WHERE tenant_id = :tenant_id")
+
 class AuthService:
     """Multi-tenant authentication service"""
     
-    def __init__(self, jwt_secret: str, jwt_algorithm: str = "HS256"):
+    def __init__(
+        self,
+        jwt_secret: str,
+        jwt_algorithm: str = "HS256",
+        token_cache_ttl: int = 0,
+        tenant_cache_ttl: int = 0,
+        api_key_cache_ttl: int = 30
+    ):
         self.jwt_secret = jwt_secret
         self.jwt_algorithm = jwt_algorithm
         self.access_token_expire_minutes = 60  # 1 hour
+        self.bcrypt_rounds = 12  # ~100-250ms per hash depending on CPU
+        
+        # One JWT instance and an already-encoded HMAC secret for every call
+        self._jwt = OrjsonJWT()
+        self._jwt_key = jwt_secret.encode() if isinstance(jwt_secret, str) else jwt_secret
+        
+        # Optional verification caches (disabled when ttl is 0)
+        self._token_cache: Optional[TTLCache] = (
+            TTLCache(maxsize=10_000, ttl=token_cache_ttl) if token_cache_ttl else None
+        )
+        self._tenant_active_cache: Optional[TTLCache] = (
+            TTLCache(maxsize=1_000, ttl=tenant_cache_ttl) if tenant_cache_ttl else None
+        )
+        self._api_key_cache: Optional[TTLCache] = (
+            TTLCache(maxsize=50_000, ttl=api_key_cache_ttl) if api_key_cache_ttl else None
+        )
     
     # JWT Authentication (for dashboards)
     async def create_access_token(self, user_data: Dict) -> str:
         """Create JWT access token for dashboard users"""
         
-        expire = datetime.utcnow() + timedelta(minutes=self.access_token_expire_minutes)
+        # Epoch seconds, serialized as-is without datetime conversion
+        now = int(time.time())
         
         payload = {
             "sub": user_data["user_id"],
             "tenant_id": user_data["tenant_id"],
             "user_type": user_data.get("user_type", "client"),
             "permissions": user_data.get("permissions", []),
-            "exp": expire,
-            "iat": datetime.utcnow(),
+            "exp": now + self.access_token_expire_minutes * 60,
+            "iat": now,
             "iss": "storepulse-auth"
         }
         
-        token = jwt.encode(payload, self.jwt_secret, algorithm=self.jwt_algorithm)
+        token = self._jwt.encode(payload, self._jwt_key, algorithm=self.jwt_algorithm)
         return token
     
-    async def verify_access_token(self, token: str) -> Dict:
+    async def verify_access_token(self, token: str, db: Optional[AsyncSession] = None) -> Dict:
         """Verify and decode JWT access token"""
         
+        # Dashboards poll with the same token, serve repeats from cache
+        cache_key = None
+        if self._token_cache is not None:
+            cache_key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+            cached = self._token_cache.get(cache_key)
+            if cached and cached["exp"] > time.time():
+                return cached
+        
         try:
-            payload = jwt.decode(token, self.jwt_secret, algorithms=[self.jwt_algorithm])
-            
-            # Check if token is expired
-            if datetime.utcnow() > datetime.fromtimestamp(payload["exp"]):
-                raise HTTPException(401, "Token expired")
+            # Expiry is enforced by PyJWT (verify_exp)
+            payload = self._jwt.decode(
+                token,
+                self._jwt_key,
+                algorithms=[self.jwt_algorithm],
+                options=JWT_DECODE_OPTIONS
+            )
+            payload["_permissions_set"] = frozenset(payload.get("permissions", []))
             
             # Verify tenant still exists and is active
             tenant_id = payload.get("tenant_id")
-            if tenant_id and not await self._verify_tenant_active(tenant_id):
+            if tenant_id and not await self._verify_tenant_active(tenant_id, db):
                 raise HTTPException(401, "Tenant inactive or not found")
             
+            if cache_key is not None:
+                self._token_cache[cache_key] = payload
+            
             return payload
             
         except jwt.InvalidTokenError as e:
@@ -70,49 +171,51 @@ class AuthService:
             raise HTTPException(401, "Token verification failed")
     
     # API Key Authentication (for gateways)
-    async def verify_api_key(self, api_key: str) -> Dict:
+    async def verify_api_key(self, api_key: str, db: Optional[AsyncSession] = None) -> Dict:
         """Verify API key and return tenant/store context"""
         
         if not api_key:
             raise HTTPException(401, "API key required")
         
         # Hash the key for database lookup
-        key_hash = hashlib.sha256(api_key.encode()).hexdigest()
+        key_hash = hash_api_key(api_key)
         
-        async with get_database() as db:
-            query = text("""
-                SELECT 
-                    k.tenant_id, k.store_id, k.key_id,
-                    t.company_name, t.is_active as tenant_active,
-                    s.store_name, s.is_active as store_active
-                FROM store_api_keys k
-                JOIN tenants t ON k.tenant_id = t.tenant_id
-                JOIN stores s ON k.tenant_id = s.tenant_id AND k.store_id = s.store_id
-                WHERE k.key_hash = :key_hash 
-                AND k.is_active = TRUE
-            """)
-            
-            result = await db.execute(query, {"key_hash": key_hash})
+        # Gateways reuse one key for every event, serve repeats from cache
+        if self._api_key_cache is not None:
+            cached = self._api_key_cache.get(key_hash)
+            if cached is not None:
+                api_key_usage.touch(key_hash)
+                return dict(cached)
+        
+        async with _use_session(db) as db:
+            # Keys issued before the BLAKE2b switch are stored as SHA-256.
+            # The lookup also sets the RLS tenant for the rest of the transaction.
+            result = await db.execute(_VERIFY_API_KEY_SQL, {
+                "key_hash": key_hash,
+                "legacy_key_hash": legacy_api_key_hash(api_key)
+            })
             key_data = result.fetchone()
             
             if not key_data:
-                logger.warning(f"Invalid API key attempt: {api_key[:16]}...")
+                # Log a hash prefix, never key material
+                logger.warning(f"Invalid API key attempt: key_hash {key_hash[:12]}...")
                 raise HTTPException(401, "Invalid API key")
             
+            # Upgrade legacy hash so cache keys and invalidation line up
+            if key_data.key_hash != key_hash:
+                await upgrade_legacy_api_key_hash(db, key_hash, key_data.key_hash)
+                await db.execute(_SET_TENANT_CONTEXT_SQL, {"tenant_id": key_data.tenant_id})
+            
             if not key_data.tenant_active:
                 raise HTTPException(401, "Tenant account is inactive")
             
             if not key_data.store_active:
                 raise HTTPException(401, "Store is inactive")
             
-            # Update last_used_at
-            await db.execute(
-                text("UPDATE store_api_keys SET last_used_at = NOW() WHERE key_hash = :key_hash"),
-                {"key_hash": key_hash}
-            )
-            await db.commit()
+            # last_used_at is written by the background flusher
+            api_key_usage.touch(key_hash)
             
-            return {
+            key_context = {
                 "tenant_id": key_data.tenant_id,
                 "store_id": key_data.store_id,
                 "key_id": key_data.key_id,
@@ -120,6 +223,20 @@ class AuthService:
                 "store_name": key_data.store_name,
                 "auth_type": "api_key"
             }
+            
+            if self._api_key_cache is not None:
+                self._api_key_cache[key_hash] = key_context
+            
+            return dict(key_context)
+    
+    def invalidate_key(self, key_hash: str):
+        """Drop cached context for an API key (after revocation or rotation)"""
+        if self._api_key_cache is not None:
+            self._api_key_cache.pop(key_hash, None)
+    
+    async def close(self):
+        """Write any pending last_used_at updates"""
+        await api_key_usage.close()
     
     # User Management (for dashboard authentication)
     async def create_dashboard_user(
@@ -127,37 +244,20 @@ class AuthService:
         tenant_id: str, 
         email: str, 
         user_type: str = "client",
-        permissions: List[str] = None
+        permissions: List[str] = None,
+        db: Optional[AsyncSession] = None
     ) -> Dict:
         """Create dashboard user for tenant"""
         
         # Generate temporary password (should be changed on first login)
         temp_password = secrets.token_urlsafe(16)
-        password_hash = self._hash_password(temp_password)
+        password_hash = await asyncio.to_thread(self._hash_password, temp_password)
         
-        async with get_database() as db:
-            # Check if user already exists
-            check_query = text("""
-                SELECT user_id FROM dashboard_users 
-                WHERE email = :email AND tenant_id = :tenant_id
-            """)
-            existing = await db.execute(check_query, {"email": email, "tenant_id": tenant_id})
-            
-            if existing.fetchone():
-                raise HTTPException(409, f"User {email} already exists for tenant {tenant_id}")
-            
-            # Insert new user
+        async with _use_session(db) as db:
+            # Insert new user, existing email for this tenant returns no row
             user_id = f"user_{tenant_id}_{secrets.token_urlsafe(8)}"
             
-            insert_query = text("""
-                INSERT INTO dashboard_users (
-                    user_id, tenant_id, email, password_hash, user_type, permissions, created_at
-                ) VALUES (
-                    :user_id, :tenant_id, :email, :password_hash, :user_type, :permissions, NOW()
-                )
-            """)
-            
-            await db.execute(insert_query, {
+            result = await db.execute(_INSERT_DASHBOARD_USER_SQL, {
                 "user_id": user_id,
                 "tenant_id": tenant_id,
                 "email": email,
@@ -166,6 +266,9 @@ class AuthService:
                 "permissions": permissions or ["read:metrics", "read:alerts"]
             })
             
+            if not result.fetchone():
+                raise HTTPException(409, f"User {email} already exists for tenant {tenant_id}")
+            
             await db.commit()
             
             logger.info(f"Created dashboard user {email} for tenant {tenant_id}")
@@ -180,26 +283,28 @@ class AuthService:
                 "password_change_required": True
             }
     
-    async def authenticate_dashboard_user(self, email: str, password: str) -> Dict:
+    async def authenticate_dashboard_user(
+        self,
+        email: str,
+        password: str,
+        db: Optional[AsyncSession] = None
+    ) -> Dict:
         """Authenticate dashboard user and return user data"""
         
-        password_hash = self._hash_password(password)
-        
-        async with get_database() as db:
-            query = text("""
-                SELECT 
-                    u.user_id, u.tenant_id, u.email, u.user_type, u.permissions,
-                    u.password_change_required, u.last_login_at,
-                    t.company_name, t.is_active as tenant_active
-                FROM dashboard_users u
-                JOIN tenants t ON u.tenant_id = t.tenant_id
-                WHERE u.email = :email 
-                AND u.password_hash = :password_hash 
-                AND u.is_active = TRUE
-            """)
+        async with _use_session(db) as db:
+            result = await db.execute(_AUTHENTICATE_USER_SQL, {"email": email})
+            candidates = result.fetchall()
+            
+            if not candidates:
+                # Spend the same bcrypt time as a wrong password for a known email
+                await asyncio.to_thread(bcrypt.checkpw, password.encode(), _DUMMY_PASSWORD_HASH)
             
-            result = await db.execute(query, {"email": email, "password_hash": password_hash})
-            user_data = result.fetchone()
+            # Same email may exist in several tenants, check each candidate
+            user_data = None
+            for candidate in candidates:
+                if await self._verify_password(password, candidate.password_hash):
+                    user_data = candidate
+                    break
             
             if not user_data:
                 logger.warning(f"Failed login attempt for {email}")
@@ -208,10 +313,15 @@ class AuthService:
             if not user_data.tenant_active:
                 raise HTTPException(401, "Tenant account is inactive")
             
+            # Rehash pre-bcrypt passwords now that we have the plaintext
+            new_hash = None
+            if self._is_legacy_hash(user_data.password_hash):
+                new_hash = await asyncio.to_thread(self._hash_password, password)
+            
             # Update last login
             await db.execute(
-                text("UPDATE dashboard_users SET last_login_at = NOW() WHERE user_id = :user_id"),
-                {"user_id": user_data.user_id}
+                _UPDATE_LAST_LOGIN_SQL,
+                {"user_id": user_data.user_id, "password_hash": new_hash}
             )
             await db.commit()
             
@@ -226,64 +336,116 @@ class AuthService:
                 "last_login_at": user_data.last_login_at
             }
     
-    async def _verify_tenant_active(self, tenant_id: str) -> bool:
+    async def _verify_tenant_active(self, tenant_id: str, db: Optional[AsyncSession] = None) -> bool:
         """Verify tenant exists and is active"""
         
-        async with get_database() as db:
-            query = text("SELECT is_active FROM tenants WHERE tenant_id = :tenant_id")
-            result = await db.execute(query, {"tenant_id": tenant_id})
+        # Single get: a contains-then-index pair can race with TTL expiry (KeyError)
+        if self._tenant_active_cache is not None:
+            cached = self._tenant_active_cache.get(tenant_id)
+            if cached is not None:
+                return cached
+        
+        async with _use_session(db) as db:
+            result = await db.execute(_TENANT_ACTIVE_SQL, {"tenant_id": tenant_id})
             tenant = result.fetchone()
             
-            return tenant and tenant.is_active
+            is_active = bool(tenant and tenant.is_active)
+            if self._tenant_active_cache is not None:
+                self._tenant_active_cache[tenant_id] = is_active
+            
+            return is_active
     
     def _hash_password(self, password: str) -> str:
-        """Hash password using SHA-256 (simple for MVP)"""
-        # In production, use bcrypt or similar
-        return hashlib.sha256(password.encode()).hexdigest()
+        """Hash password using bcrypt (blocking, run in a thread)"""
+        salt = bcrypt.gensalt(self.bcrypt_rounds)
+        return bcrypt.hashpw(password.encode(), salt).decode()
+    
+    async def _verify_password(self, password: str, stored_hash: str) -> bool:
+        """Verify password against stored bcrypt hash without blocking the event loop"""
+        if self._is_legacy_hash(stored_hash):
+            # Pre-bcrypt SHA-256 hex digest, compare in constant time
+            legacy_hash = hashlib.sha256(password.encode()).hexdigest()
+            return hmac.compare_digest(legacy_hash, stored_hash)
+        
+        return await asyncio.to_thread(bcrypt.checkpw, password.encode(), stored_hash.encode())
+    
+    @staticmethod
+    def _is_legacy_hash(stored_hash: str) -> bool:
+        """Check for SHA-256 hashes stored before the bcrypt migration"""
+        return not stored_hash.startswith("$2")
 
 
 # Initialize auth service (will be configured in main app)
 auth_service: Optional[AuthService] = None
 
-def init_auth_service(jwt_secret: str):
-    """Initialize auth service with JWT secret"""
+def init_auth_service(
+    jwt_secret: str,
+    token_cache_ttl: int = 0,
+    tenant_cache_ttl: int = 0,
+    api_key_cache_ttl: int = 30
+):
+    """Initialize auth service with JWT secret (no event loop needed)"""
     global auth_service
-    auth_service = AuthService(jwt_secret)
+    auth_service = AuthService(
+        jwt_secret,
+        token_cache_ttl=token_cache_ttl,
+        tenant_cache_ttl=tenant_cache_ttl,
+        api_key_cache_ttl=api_key_cache_ttl
+    )
+
+async def shutdown_auth_service():
+    """Flush pending auth writes, call from the app lifespan on shutdown"""
+    if auth_service:
+        await auth_service.close()
+
+def invalidate_api_key(key_hash: str):
+    """Drop cached API key context (auth and tenant middleware), call after deactivating keys"""
+    if auth_service:
+        auth_service.invalidate_key(key_hash)
+    invalidate_cached_api_key(key_hash)
 
 # Dependencies for FastAPI
-async def get_current_user_jwt(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Dict:
+async def get_current_user_jwt(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: AsyncSession = Depends(get_db)
+) -> Dict:
     """FastAPI dependency to get current user from JWT token"""
     
     if not auth_service:
         raise HTTPException(500, "Auth service not initialized")
     
     token = credentials.credentials
-    user_data = await auth_service.verify_access_token(token)
+    user_data = await auth_service.verify_access_token(token, db)
     return user_data
 
-async def get_current_user_api_key(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Dict:
+async def get_current_user_api_key(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: AsyncSession = Depends(get_db)
+) -> Dict:
     """FastAPI dependency to get current user from API key"""
     
     if not auth_service:
         raise HTTPException(500, "Auth service not initialized")
     
     api_key = credentials.credentials
-    key_data = await auth_service.verify_api_key(api_key)
+    key_data = await auth_service.verify_api_key(api_key, db)
     return key_data
 
 # Permission checking
 def require_permissions(required_permissions: List[str]):
     """Decorator to require specific permissions"""
     
+    required = frozenset(required_permissions)
+    
     def dependency(current_user: Dict = Depends(get_current_user_jwt)):
-        user_permissions = current_user.get("permissions", [])
+        user_permissions = current_user["_permissions_set"]
         
-        for permission in required_permissions:
-            if permission not in user_permissions:
-                raise HTTPException(
-                    403, 
-                    f"Permission denied. Required: {permission}"
-                )
+        if not required.issubset(user_permissions):
+            missing = next(p for p in required_permissions if p not in user_permissions)
+            raise HTTPException(
+                403, 
+                f"Permission denied. Required: {missing}"
+            )
         
         return current_user
     
@@ -309,7 +471,7 @@ CREATE TABLE IF NOT EXISTS dashboard_users (
     user_id VARCHAR(100) PRIMARY KEY,
     tenant_id VARCHAR(50) NOT NULL,
     email VARCHAR(255) NOT NULL,
-    password_hash VARCHAR(128) NOT NULL,
+    password_hash VARCHAR(255) NOT NULL,  -- bcrypt ($2b$12$...)
     user_type VARCHAR(20) DEFAULT 'client',  -- 'client', 'admin', 'readonly'
     permissions JSONB DEFAULT '[]',
     is_active BOOLEAN DEFAULT TRUE,
@@ -318,9 +480,8 @@ CREATE TABLE IF NOT EXISTS dashboard_users (
     last_login_at TIMESTAMPTZ,
     
     FOREIGN KEY (tenant_id) REFERENCES tenants(tenant_id),
-    UNIQUE(email, tenant_id)
+    UNIQUE(email, tenant_id)  -- also serves login lookups by email
 );
 
-CREATE INDEX idx_dashboard_users_email ON dashboard_users(email);
 CREATE INDEX idx_dashboard_users_tenant ON dashboard_users(tenant_id);
 """
\ No newline at end of file
@@ -0,0 +1,28 @@
+# JWT Codec
+# StorePulse - orjson-backed JWT encoding and the decode options for access tokens
+
+from typing import Optional, Dict
+import jwt
+import orjson
+
+# Only exp is time-checked, aud/iss are not used by our tokens
+JWT_DECODE_OPTIONS = {
+    "verify_aud": False,
+    "verify_iss": False,
+    "require": ["exp", "sub", "tenant_id"]
+}
+
+class OrjsonJWT(jwt.PyJWT):
+    """PyJWT with orjson payload (de)serialization"""
+    
+    def _encode_payload(self, payload: Dict, headers: Optional[Dict] = None, json_encoder=None) -> bytes:
+        return orjson.dumps(payload)
+    
+    def _decode_payload(self, decoded: Dict) -> Dict:
+        try:
+            payload = orjson.loads(decoded["payload"])
+        except orjson.JSONDecodeError as e:
+            raise jwt.DecodeError(f"Invalid payload string: {e}")
+        if not isinstance(payload, dict):
+            raise jwt.DecodeError("Invalid payload string: must be a json object")
+        return payload
@@ -4,18 +4,108 @@
 from fastapi import APIRouter, HTTPException, Depends, status
 from pydantic import BaseModel, EmailStr
 from sqlalchemy import text
-from typing import List, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from cachetools import TTLCache
+from typing import List, Optional, FrozenSet
 from datetime import datetime
+from functools import lru_cache
 import secrets
-import hashlib
+import base64
 import logging
 
-from .tenant_middleware import get_tenant_id
-from .database import get_database
+from .tenant_middleware import get_tenant_id, get_db, hash_api_key
+from .auth import invalidate_api_key
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/v1/admin/tenants", tags=["Tenant Management"])
 
+# SQL statements (built once, reused on every call)
+_INSERT_TENANT_SQL = text("""
+    INSERT INTO tenants (
+        tenant_id, company_name, plan_type, max_stores, max_monthly_cost,
+        billing_email, admin_contact, whatsapp_numbers, config
+    ) VALUES (
+        :tenant_id, :company_name, :plan_type, :max_stores, :max_monthly_cost,
+        :billing_email, :admin_contact, :whatsapp_numbers, :config
+    )
+    ON CONFLICT (tenant_id) DO NOTHING
+    RETURNING tenant_id, company_name, plan_type, max_stores, max_monthly_cost,
+              created_at, is_active, billing_email, admin_contact, whatsapp_numbers, config
+""")
+_LIST_TENANTS_SQL = text("""
+    -- DECIMAL as float8: rows skip model validation, so no Decimal -> float coercion
+    SELECT tenant_id, company_name, plan_type, max_stores, max_monthly_cost::float8 as max_monthly_cost,
+           created_at, is_active, billing_email, admin_contact, whatsapp_numbers, config
+    FROM tenants
+    WHERE (:active_only = FALSE OR is_active = TRUE)
+    ORDER BY created_at DESC
+""")
+_GET_TENANT_SQL = text("""
+    SELECT tenant_id, company_name, plan_type, max_stores, max_monthly_cost,
+           created_at, is_active, billing_email, admin_contact, whatsapp_numbers, config
+    FROM tenants
+    WHERE tenant_id = :tenant_id
+""")
+_TENANT_MAX_STORES_SQL = text("SELECT max_stores FROM tenants WHERE tenant_id = :tenant_id AND is_active = TRUE")
+_COUNT_ACTIVE_STORES_SQL = text("SELECT COUNT(*) as count FROM stores WHERE tenant_id = :tenant_id AND is_active = TRUE")
+_INSERT_STORE_SQL = text("""
+    INSERT INTO stores (tenant_id, store_id, store_name, config)
+    VALUES (:tenant_id, :store_id, :store_name, :config)
+    ON CONFLICT (tenant_id, store_id) DO NOTHING
+    RETURNING tenant_id, store_id, store_name, config, created_at, is_active
+""")
+_LIST_STORES_SQL = text("""
+    SELECT tenant_id, store_id, store_name, config, created_at, is_active
+    FROM stores
+    WHERE tenant_id = :tenant_id
+    ORDER BY created_at DESC
+""")
+_GET_STORE_SQL = text("""
+    SELECT tenant_id, store_id, store_name, config, created_at, is_active
+    FROM stores
+    WHERE tenant_id = :tenant_id AND store_id = :store_id
+""")
+_ACTIVE_STORE_SQL = text("SELECT store_id FROM stores WHERE tenant_id = :tenant_id AND store_id = :store_id AND is_active = TRUE")
+_DEACTIVATE_STORE_KEYS_SQL = text("""
+    UPDATE store_api_keys 
+    SET is_active = FALSE 
+    WHERE tenant_id = :tenant_id AND store_id = :store_id AND is_active = TRUE
+    RETURNING key_hash
+""")
+_INSERT_API_KEY_SQL = text("""
+    INSERT INTO store_api_keys (key_id, tenant_id, store_id, key_hash)
+    VALUES (:key_id, :tenant_id, :store_id, :key_hash)
+""")
+_LIST_API_KEYS_SQL = text("""
+    SELECT key_id, tenant_id, store_id, created_at, last_used_at, is_active
+    FROM store_api_keys
+    WHERE tenant_id = :tenant_id
+    ORDER BY created_at DESC
+""")
+_REVOKE_API_KEY_SQL = text("""
+    UPDATE store_api_keys 
+    SET is_active = FALSE 
+    WHERE key_id = :key_id AND tenant_id = :tenant_id
+    RETURNING key_id, key_hash
+""")
+# Event counts come from the hourly rollup (see TENANT_METRICS_COUNTERS_SCHEMA)
+_TENANT_STATS_SQL = text("""
+    SELECT
+        (SELECT COUNT(*) FROM stores
+         WHERE tenant_id = :tenant_id AND is_active = TRUE) as store_count,
+        (SELECT COALESCE(SUM(event_count), 0) FROM tenant_metrics_counters
+         WHERE tenant_id = :tenant_id
+         AND bucket_hour > NOW() - INTERVAL '24 hours') as daily_events,
+        (SELECT COUNT(*) FROM alerts
+         WHERE tenant_id = :tenant_id AND status = 'active') as active_alerts,
+        (SELECT last_seen FROM tenant_metrics_counters
+         WHERE tenant_id = :tenant_id
+         ORDER BY bucket_hour DESC LIMIT 1) as last_activity
+""")
+
+# Stats don't need second-level freshness
+_tenant_stats_cache = TTLCache(maxsize=1_000, ttl=60)
+
 # Pydantic models
 class TenantCreate(BaseModel):
     tenant_id: str
@@ -62,364 +152,338 @@ class APIKeyResponse(BaseModel):
     created_at: datetime
     is_active: bool
 
+_UPDATABLE_TENANT_FIELDS = frozenset({
+    "company_name", "plan_type", "max_stores", "max_monthly_cost",
+    "billing_email", "admin_contact", "whatsapp_numbers", "config", "is_active"
+})
+
+@lru_cache(maxsize=128)
+def _update_tenant_sql(fields: FrozenSet[str]):
+    """Build UPDATE statement for a set of tenant fields (cached per field set)"""
+    set_clauses = ", ".join(f"{field} = :{field}" for field in sorted(fields))
+    return text(f"""
+        UPDATE tenants 
+        SET {set_clauses}
+        WHERE tenant_id = :tenant_id
+        RETURNING tenant_id
+    """)
+
 # Tenant CRUD operations
 @router.post("/", response_model=TenantResponse, status_code=status.HTTP_201_CREATED)
-async def create_tenant(tenant: TenantCreate):
+async def create_tenant(tenant: TenantCreate, db: AsyncSession = Depends(get_db)):
     """Create a new tenant (client)"""
     
-    async with get_database() as db:
-        # Check if tenant_id already exists
-        check_query = text("SELECT tenant_id FROM tenants WHERE tenant_id = :tenant_id")
-        result = await db.execute(check_query, {"tenant_id": tenant.tenant_id})
-        
-        if result.fetchone():
-            raise HTTPException(409, f"Tenant {tenant.tenant_id} already exists")
-        
-        # Insert new tenant
-        insert_query = text("""
-            INSERT INTO tenants (
-                tenant_id, company_name, plan_type, max_stores, max_monthly_cost,
-                billing_email, admin_contact, whatsapp_numbers, config
-            ) VALUES (
-                :tenant_id, :company_name, :plan_type, :max_stores, :max_monthly_cost,
-                :billing_email, :admin_contact, :whatsapp_numbers, :config
-            )
-        """)
-        
-        await db.execute(insert_query, {
-            "tenant_id": tenant.tenant_id,
-            "company_name": tenant.company_name,
-            "plan_type": tenant.plan_type,
-            "max_stores": tenant.max_stores,
-            "max_monthly_cost": tenant.max_monthly_cost,
-            "billing_email": tenant.billing_email,
-            "admin_contact": tenant.admin_contact,
-            "whatsapp_numbers": tenant.whatsapp_numbers,
-            "config": tenant.config
-        })
-        
-        await db.commit()
-        
-        logger.info(f"Created new tenant: {tenant.tenant_id} ({tenant.company_name})")
-        
-        # Return created tenant
-        return await get_tenant(tenant.tenant_id)
+    # Insert new tenant, existing tenant_id returns no row
+    result = await db.execute(_INSERT_TENANT_SQL, {
+        "tenant_id": tenant.tenant_id,
+        "company_name": tenant.company_name,
+        "plan_type": tenant.plan_type,
+        "max_stores": tenant.max_stores,
+        "max_monthly_cost": tenant.max_monthly_cost,
+        "billing_email": tenant.billing_email,
+        "admin_contact": tenant.admin_contact,
+        "whatsapp_numbers": tenant.whatsapp_numbers,
+        "config": tenant.config
+    })
+    
+    created = result.fetchone()
+    if not created:
+        raise HTTPException(409, f"Tenant {tenant.tenant_id} already exists")
+    
+    await db.commit()
+    
+    logger.info(f"Created new tenant: {tenant.tenant_id} ({tenant.company_name})")
+    
+    # Return created tenant straight from RETURNING (validated: coerces DECIMAL cost to float)
+    return TenantResponse(**created._mapping)
 
-@router.get("/", response_model=List[TenantResponse])
-async def list_tenants(active_only: bool = True):
+# List endpoints return rows from our own schema: skip per-row validation
+# (model_construct) and FastAPI response re-validation, keep the docs schema
+@router.get("/", response_model=None, responses={200: {"model": List[TenantResponse]}})
+async def list_tenants(active_only: bool = True, db: AsyncSession = Depends(get_db)):
     """List all tenants"""
     
-    async with get_database() as db:
-        query = text("""
-            SELECT tenant_id, company_name, plan_type, max_stores, max_monthly_cost,
-                   created_at, is_active, billing_email, admin_contact, whatsapp_numbers, config
-            FROM tenants
-            WHERE (:active_only = FALSE OR is_active = TRUE)
-            ORDER BY created_at DESC
-        """)
-        
-        result = await db.execute(query, {"active_only": active_only})
-        tenants = result.fetchall()
-        
-        return [TenantResponse(**dict(tenant)) for tenant in tenants]
+    result = await db.execute(_LIST_TENANTS_SQL, {"active_only": active_only})
+    tenants = result.fetchall()
+    
+    return [TenantResponse.model_construct(**tenant._mapping) for tenant in tenants]
 
 @router.get("/{tenant_id}", response_model=TenantResponse)
-async def get_tenant(tenant_id: str):
+async def get_tenant(tenant_id: str, db: AsyncSession = Depends(get_db)):
     """Get tenant details"""
     
-    async with get_database() as db:
-        query = text("""
-            SELECT tenant_id, company_name, plan_type, max_stores, max_monthly_cost,
-                   created_at, is_active, billing_email, admin_contact, whatsapp_numbers, config
-            FROM tenants
-            WHERE tenant_id = :tenant_id
-        """)
-        
-        result = await db.execute(query, {"tenant_id": tenant_id})
-        tenant = result.fetchone()
-        
-        if not tenant:
-            raise HTTPException(404, f"Tenant {tenant_id} not found")
-        
-        return TenantResponse(**dict(tenant))
+    result = await db.execute(_GET_TENANT_SQL, {"tenant_id": tenant_id})
+    tenant = result.fetchone()
+    
+    if not tenant:
+        raise HTTPException(404, f"Tenant {tenant_id} not found")
+    
+    return TenantResponse(**dict(tenant))
 
 @router.put("/{tenant_id}", response_model=TenantResponse)
-async def update_tenant(tenant_id: str, updates: dict):
+async def update_tenant(tenant_id: str, updates: dict, db: AsyncSession = Depends(get_db)):
     """Update tenant configuration"""
     
     if not updates:
         raise HTTPException(400, "No updates provided")
     
-    # Build dynamic update query
-    set_clauses = []
-    params = {"tenant_id": tenant_id}
+    fields = {field: value for field, value in updates.items() if field in _UPDATABLE_TENANT_FIELDS}
     
-    allowed_fields = {
-        "company_name", "plan_type", "max_stores", "max_monthly_cost",
-        "billing_email", "admin_contact", "whatsapp_numbers", "config", "is_active"
-    }
+    if not fields:
+        raise HTTPException(400, "No valid fields to update")
     
-    for field, value in updates.items():
-        if field in allowed_fields:
-            set_clauses.append(f"{field} = :{field}")
-            params[field] = value
+    # Statement is cached per field set, single-field updates reuse it
+    query = _update_tenant_sql(frozenset(fields))
     
-    if not set_clauses:
-        raise HTTPException(400, "No valid fields to update")
+    result = await db.execute(query, {"tenant_id": tenant_id, **fields})
+    updated = result.fetchone()
     
-    async with get_database() as db:
-        query = text(f"""
-            UPDATE tenants 
-            SET {', '.join(set_clauses)}
-            WHERE tenant_id = :tenant_id
-            RETURNING tenant_id
-        """)
-        
-        result = await db.execute(query, params)
-        updated = result.fetchone()
-        
-        if not updated:
-            raise HTTPException(404, f"Tenant {tenant_id} not found")
-        
-        await db.commit()
-        
-        logger.info(f"Updated tenant {tenant_id}: {list(updates.keys())}")
-        
-        return await get_tenant(tenant_id)
+    if not updated:
+        raise HTTPException(404, f"Tenant {tenant_id} not found")
+    
+    await db.commit()
+    
+    logger.info(f"Updated tenant {tenant_id}: {list(updates.keys())}")
+    
+    return await get_tenant(tenant_id, db)
 
 # Store management
 @router.post("/{tenant_id}/stores", response_model=StoreResponse, status_code=status.HTTP_201_CREATED)
-async def create_store(tenant_id: str, store: StoreCreate):
+async def create_store(tenant_id: str, store: StoreCreate, db: AsyncSession = Depends(get_db)):
     """Create a new store for tenant"""
     
-    async with get_database() as db:
-        # Verify tenant exists and check store limit
-        tenant_query = text("SELECT max_stores FROM tenants WHERE tenant_id = :tenant_id AND is_active = TRUE")
-        tenant_result = await db.execute(tenant_query, {"tenant_id": tenant_id})
-        tenant_data = tenant_result.fetchone()
-        
-        if not tenant_data:
-            raise HTTPException(404, f"Tenant {tenant_id} not found or inactive")
-        
-        # Count existing stores
-        count_query = text("SELECT COUNT(*) as count FROM stores WHERE tenant_id = :tenant_id AND is_active = TRUE")
-        count_result = await db.execute(count_query, {"tenant_id": tenant_id})
-        store_count = count_result.fetchone().count
-        
-        if store_count >= tenant_data.max_stores:
-            raise HTTPException(409, f"Store limit reached: {store_count}/{tenant_data.max_stores}")
-        
-        # Check if store_id already exists for this tenant
-        check_query = text("SELECT store_id FROM stores WHERE tenant_id = :tenant_id AND store_id = :store_id")
-        check_result = await db.execute(check_query, {"tenant_id": tenant_id, "store_id": store.store_id})
-        
-        if check_result.fetchone():
-            raise HTTPException(409, f"Store {store.store_id} already exists for tenant {tenant_id}")
-        
-        # Insert new store
-        insert_query = text("""
-            INSERT INTO stores (tenant_id, store_id, store_name, config)
-            VALUES (:tenant_id, :store_id, :store_name, :config)
-        """)
-        
-        await db.execute(insert_query, {
-            "tenant_id": tenant_id,
-            "store_id": store.store_id,
-            "store_name": store.store_name,
-            "config": store.config
-        })
-        
-        await db.commit()
-        
-        logger.info(f"Created store {store.store_id} for tenant {tenant_id}")
-        
-        return await get_store(tenant_id, store.store_id)
+    # Verify tenant exists and check store limit
+    tenant_result = await db.execute(_TENANT_MAX_STORES_SQL, {"tenant_id": tenant_id})
+    tenant_data = tenant_result.fetchone()
+    
+    if not tenant_data:
+        raise HTTPException(404, f"Tenant {tenant_id} not found or inactive")
+    
+    # Count existing stores
+    count_result = await db.execute(_COUNT_ACTIVE_STORES_SQL, {"tenant_id": tenant_id})
+    store_count = count_result.fetchone().count
+    
+    if store_count >= tenant_data.max_stores:
+        raise HTTPException(409, f"Store limit reached: {store_count}/{tenant_data.max_stores}")
+    
+    # Insert new store, existing store_id returns no row
+    result = await db.execute(_INSERT_STORE_SQL, {
+        "tenant_id": tenant_id,
+        "store_id": store.store_id,
+        "store_name": store.store_name,
+        "config": store.config
+    })
+    
+    created = result.fetchone()
+    if not created:
+        raise HTTPException(409, f"Store {store.store_id} already exists for tenant {tenant_id}")
+    
+    await db.commit()
+    
+    logger.info(f"Created store {store.store_id} for tenant {tenant_id}")
+    
+    return StoreResponse(**created._mapping)
 
-@router.get("/{tenant_id}/stores", response_model=List[StoreResponse])
-async def list_tenant_stores(tenant_id: str):
+@router.get("/{tenant_id}/stores", response_model=None, responses={200: {"model": List[StoreResponse]}})
+async def list_tenant_stores(tenant_id: str, db: AsyncSession = Depends(get_db)):
     """List all stores for a tenant"""
     
-    async with get_database() as db:
-        query = text("""
-            SELECT tenant_id, store_id, store_name, config, created_at, is_active
-            FROM stores
-            WHERE tenant_id = :tenant_id
-            ORDER BY created_at DESC
-        """)
-        
-        result = await db.execute(query, {"tenant_id": tenant_id})
-        stores = result.fetchall()
-        
-        return [StoreResponse(**dict(store)) for store in stores]
+    result = await db.execute(_LIST_STORES_SQL, {"tenant_id": tenant_id})
+    stores = result.fetchall()
+    
+    return [StoreResponse.model_construct(**store._mapping) for store in stores]
 
 @router.get("/{tenant_id}/stores/{store_id}", response_model=StoreResponse)
-async def get_store(tenant_id: str, store_id: str):
+async def get_store(tenant_id: str, store_id: str, db: AsyncSession = Depends(get_db)):
     """Get store details"""
     
-    async with get_database() as db:
-        query = text("""
-            SELECT tenant_id, store_id, store_name, config, created_at, is_active
-            FROM stores
-            WHERE tenant_id = :tenant_id AND store_id = :store_id
-        """)
-        
-        result = await db.execute(query, {"tenant_id": tenant_id, "store_id": store_id})
-        store = result.fetchone()
-        
-        if not store:
-            raise HTTPException(404, f"Store {store_id} not found for tenant {tenant_id}")
-        
-        return StoreResponse(**dict(store))
+    result = await db.execute(_GET_STORE_SQL, {"tenant_id": tenant_id, "store_id": store_id})
+    store = result.fetchone()
+    
+    if not store:
+        raise HTTPException(404, f"Store {store_id} not found for tenant {tenant_id}")
+    
+    return StoreResponse(**dict(store))
 
 # API Key management
 @router.post("/{tenant_id}/stores/{store_id}/api-key", response_model=APIKeyResponse, status_code=status.HTTP_201_CREATED)
-async def generate_api_key(tenant_id: str, store_id: str):
+async def generate_api_key(tenant_id: str, store_id: str, db: AsyncSession = Depends(get_db)):
     """Generate new API key for store"""
     
-    async with get_database() as db:
-        # Verify store exists
-        store_query = text("SELECT store_id FROM stores WHERE tenant_id = :tenant_id AND store_id = :store_id AND is_active = TRUE")
-        store_result = await db.execute(store_query, {"tenant_id": tenant_id, "store_id": store_id})
-        
-        if not store_result.fetchone():
-            raise HTTPException(404, f"Store {store_id} not found for tenant {tenant_id}")
-        
-        # Deactivate existing API keys for this store
-        deactivate_query = text("""
-            UPDATE store_api_keys 
-            SET is_active = FALSE 
-            WHERE tenant_id = :tenant_id AND store_id = :store_id
-        """)
-        await db.execute(deactivate_query, {"tenant_id": tenant_id, "store_id": store_id})
-        
-        # Generate new API key
-        api_key = f"store_{tenant_id}_{store_id}_{secrets.token_urlsafe(32)}"
-        key_id = f"store_{tenant_id}_{store_id}"
-        key_hash = hashlib.sha256(api_key.encode()).hexdigest()
-        
-        # Insert new API key
-        insert_query = text("""
-            INSERT INTO store_api_keys (key_id, tenant_id, store_id, key_hash)
-            VALUES (:key_id, :tenant_id, :store_id, :key_hash)
-        """)
-        
-        await db.execute(insert_query, {
-            "key_id": key_id,
-            "tenant_id": tenant_id,
-            "store_id": store_id,
-            "key_hash": key_hash
-        })
-        
-        await db.commit()
-        
-        logger.info(f"Generated new API key for {tenant_id}/{store_id}")
-        
-        return APIKeyResponse(
-            key_id=key_id,
-            tenant_id=tenant_id,
-            store_id=store_id,
-            api_key=api_key,  # Only shown on creation
-            created_at=datetime.utcnow(),
-            is_active=True
-        )
+    # Verify store exists
+    store_result = await db.execute(_ACTIVE_STORE_SQL, {"tenant_id": tenant_id, "store_id": store_id})
+    
+    if not store_result.fetchone():
+        raise HTTPException(404, f"Store {store_id} not found for tenant {tenant_id}")
+    
+    # Deactivate existing API keys for this store
+    deactivated = await db.execute(_DEACTIVATE_STORE_KEYS_SQL, {"tenant_id": tenant_id, "store_id": store_id})
+    old_key_hashes = [row.key_hash for row in deactivated.fetchall()]
+    
+    # Generate new API key (tenant/store live in their own columns, not in the key)
+    api_key = base64.urlsafe_b64encode(secrets.token_bytes(32)).rstrip(b"=").decode()
+    key_id = f"store_{tenant_id}_{store_id}"
+    key_hash = hash_api_key(api_key)
+    
+    # Insert new API key
+    await db.execute(_INSERT_API_KEY_SQL, {
+        "key_id": key_id,
+        "tenant_id": tenant_id,
+        "store_id": store_id,
+        "key_hash": key_hash
+    })
+    
+    await db.commit()
+    
+    for old_key_hash in old_key_hashes:
+        invalidate_api_key(old_key_hash)
+    
+    logger.info(f"Generated new API key for {tenant_id}/{store_id}")
+    
+    return APIKeyResponse(
+        key_id=key_id,
+        tenant_id=tenant_id,
+        store_id=store_id,
+        api_key=api_key,  # Only shown on creation
+        created_at=datetime.utcnow(),
+        is_active=True
+    )
 
-@router.get("/{tenant_id}/api-keys")
-async def list_api_keys(tenant_id: str):
+@router.get("/{tenant_id}/api-keys", response_model=None)
+async def list_api_keys(tenant_id: str, db: AsyncSession = Depends(get_db)):
     """List API keys for tenant (without showing actual keys)"""
     
-    async with get_database() as db:
-        query = text("""
-            SELECT key_id, tenant_id, store_id, created_at, last_used_at, is_active
-            FROM store_api_keys
-            WHERE tenant_id = :tenant_id
-            ORDER BY created_at DESC
-        """)
-        
-        result = await db.execute(query, {"tenant_id": tenant_id})
-        keys = result.fetchall()
-        
-        return [
-            {
-                "key_id": key.key_id,
-                "tenant_id": key.tenant_id,
-                "store_id": key.store_id,
-                "created_at": key.created_at,
-                "last_used_at": key.last_used_at,
-                "is_active": key.is_active
-            }
-            for key in keys
-        ]
+    result = await db.execute(_LIST_API_KEYS_SQL, {"tenant_id": tenant_id})
+    
+    # Query selects exactly the public columns (never key_hash)
+    return [dict(key._mapping) for key in result.fetchall()]
 
 @router.delete("/{tenant_id}/api-keys/{key_id}")
-async def revoke_api_key(tenant_id: str, key_id: str):
+async def revoke_api_key(tenant_id: str, key_id: str, db: AsyncSession = Depends(get_db)):
     """Revoke API key"""
     
-    async with get_database() as db:
-        query = text("""
-            UPDATE store_api_keys 
-            SET is_active = FALSE 
-            WHERE key_id = :key_id AND tenant_id = :tenant_id
-            RETURNING key_id
-        """)
-        
-        result = await db.execute(query, {"key_id": key_id, "tenant_id": tenant_id})
-        updated = result.fetchone()
-        
-        if not updated:
-            raise HTTPException(404, f"API key {key_id} not found for tenant {tenant_id}")
-        
-        await db.commit()
-        
-        logger.info(f"Revoked API key {key_id} for tenant {tenant_id}")
-        
-        return {"message": f"API key {key_id} revoked successfully"}
+    result = await db.execute(_REVOKE_API_KEY_SQL, {"key_id": key_id, "tenant_id": tenant_id})
+    updated = result.fetchone()
+    
+    if not updated:
+        raise HTTPException(404, f"API key {key_id} not found for tenant {tenant_id}")
+    
+    await db.commit()
+    
+    invalidate_api_key(updated.key_hash)
+    
+    logger.info(f"Revoked API key {key_id} for tenant {tenant_id}")
+    
+    return {"message": f"API key {key_id} revoked successfully"}
 
 
 # Tenant statistics and usage
 @router.get("/{tenant_id}/stats")
-async def get_tenant_stats(tenant_id: str):
+async def get_tenant_stats(tenant_id: str, db: AsyncSession = Depends(get_db)):
     """Get tenant usage statistics"""
     
-    async with get_database() as db:
-        # Store count
-        stores_query = text("SELECT COUNT(*) as count FROM stores WHERE tenant_id = :tenant_id AND is_active = TRUE")
-        stores_result = await db.execute(stores_query, {"tenant_id": tenant_id})
-        store_count = stores_result.fetchone().count
-        
-        # Events in last 24 hours
-        events_query = text("""
-            SELECT COUNT(*) as count 
-            FROM metrics 
-            WHERE tenant_id = :tenant_id 
-            AND created_at > NOW() - INTERVAL '24 hours'
-        """)
-        events_result = await db.execute(events_query, {"tenant_id": tenant_id})
-        daily_events = events_result.fetchone().count
-        
-        # Active alerts
-        alerts_query = text("""
-            SELECT COUNT(*) as count 
-            FROM alerts 
-            WHERE tenant_id = :tenant_id 
-            AND status = 'active'
-        """)
-        alerts_result = await db.execute(alerts_query, {"tenant_id": tenant_id})
-        active_alerts = alerts_result.fetchone().count
-        
-        # Last activity
-        activity_query = text("""
-            SELECT MAX(created_at) as last_activity 
-            FROM metrics 
-            WHERE tenant_id = :tenant_id
-        """)
-        activity_result = await db.execute(activity_query, {"tenant_id": tenant_id})
-        last_activity = activity_result.fetchone().last_activity
-        
-        return {
-            "tenant_id": tenant_id,
-            "store_count": store_count,
-            "daily_events": daily_events,
-            "active_alerts": active_alerts,
-            "last_activity": last_activity,
-            "projected_monthly_events": daily_events * 30 if daily_events else 0
-        }
\ No newline at end of file
+    cached = _tenant_stats_cache.get(tenant_id)
+    if cached is not None:
+        return cached
+    
+    result = await db.execute(_TENANT_STATS_SQL, {"tenant_id": tenant_id})
+    stats = result.fetchone()
+    
+    daily_events = stats.daily_events
+    
+    tenant_stats = {
+        "tenant_id": tenant_id,
+        "store_count": stats.store_count,
+        "daily_events": daily_events,
+        "active_alerts": stats.active_alerts,
+        "last_activity": stats.last_activity,
+        "projected_monthly_events": daily_events * 30 if daily_events else 0
+    }
+    
+    _tenant_stats_cache[tenant_id] = tenant_stats
+    
+    return tenant_stats
+
+# Hourly per-tenant rollup of metrics, maintained by a statement-level trigger
+# so stats never scan the metrics table
+TENANT_METRICS_COUNTERS_SCHEMA = """
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS tenant_metrics_counters (
+    tenant_id VARCHAR(50) NOT NULL,
+    bucket_hour TIMESTAMPTZ NOT NULL,
+    event_count BIGINT NOT NULL DEFAULT 0,
+    last_seen TIMESTAMPTZ NOT NULL,
+    
+    PRIMARY KEY (tenant_id, bucket_hour)
+);
+
+CREATE OR REPLACE FUNCTION bump_tenant_metrics_counters() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO tenant_metrics_counters (tenant_id, bucket_hour, event_count, last_seen)
+    SELECT tenant_id, date_trunc('hour', created_at), COUNT(*), MAX(created_at)
+    FROM new_metrics
+    WHERE created_at IS NOT NULL
+    GROUP BY tenant_id, date_trunc('hour', created_at)
+    ON CONFLICT (tenant_id, bucket_hour) DO UPDATE
+    SET event_count = tenant_metrics_counters.event_count + EXCLUDED.event_count,
+        last_seen = GREATEST(tenant_metrics_counters.last_seen, EXCLUDED.last_seen);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Block metric inserts until the trigger and backfill commit together,
+-- so no row is missed or counted twice (the backfill is bounded to keep this short)
+LOCK TABLE metrics IN SHARE ROW EXCLUSIVE MODE;
+
+DROP TRIGGER IF EXISTS metrics_counters_trigger ON metrics;
+CREATE TRIGGER metrics_counters_trigger
+    AFTER INSERT ON metrics
+    REFERENCING NEW TABLE AS new_metrics
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_tenant_metrics_counters();
+
+-- Backfill only what stats read: the last ~25 hourly buckets, plus each
+-- tenant's newest older bucket for last_activity. Buckets are recomputed
+-- exactly, so re-running overwrites instead of double counting.
+WITH cutoff AS (
+    SELECT date_trunc('hour', NOW() - INTERVAL '25 hours') AS ts
+),
+recent AS (
+    SELECT m.tenant_id, date_trunc('hour', m.created_at) AS bucket_hour,
+           COUNT(*) AS event_count, MAX(m.created_at) AS last_seen
+    FROM metrics m, cutoff
+    WHERE m.created_at >= cutoff.ts
+    GROUP BY 1, 2
+),
+older_last AS (
+    -- Per-store index lookups (tenant_id, store_id, created_at) instead of a scan
+    SELECT s.tenant_id, date_trunc('hour', MAX(l.last_seen)) AS bucket_hour
+    FROM stores s
+    CROSS JOIN cutoff
+    CROSS JOIN LATERAL (
+        SELECT MAX(m.created_at) AS last_seen
+        FROM metrics m
+        WHERE m.tenant_id = s.tenant_id AND m.store_id = s.store_id
+        AND m.created_at < cutoff.ts
+    ) l
+    GROUP BY s.tenant_id
+    HAVING MAX(l.last_seen) IS NOT NULL
+),
+older AS (
+    SELECT o.tenant_id, o.bucket_hour, COUNT(*) AS event_count, MAX(m.created_at) AS last_seen
+    FROM older_last o
+    JOIN metrics m ON m.tenant_id = o.tenant_id
+        AND m.created_at >= o.bucket_hour
+        AND m.created_at < o.bucket_hour + INTERVAL '1 hour'
+    GROUP BY o.tenant_id, o.bucket_hour
+)
+INSERT INTO tenant_metrics_counters (tenant_id, bucket_hour, event_count, last_seen)
+SELECT tenant_id, bucket_hour, event_count, last_seen FROM recent
+UNION ALL
+SELECT tenant_id, bucket_hour, event_count, last_seen FROM older
+ON CONFLICT (tenant_id, bucket_hour) DO UPDATE
+SET event_count = EXCLUDED.event_count,
+    last_seen = EXCLUDED.last_seen;
+
+COMMIT;
+"""
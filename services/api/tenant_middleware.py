@@ -4,14 +4,129 @@
 from fastapi import Request, HTTPException, status
 from fastapi.responses import JSONResponse
 from sqlalchemy import text
-from typing import Optional
+from sqlalchemy.engine import make_url
+from typing import Optional, AsyncIterator
+from collections import OrderedDict
+import redis.asyncio as aioredis
+import asyncpg
+import orjson
+import weakref
 import hashlib
 import asyncio
-from datetime import datetime, timedelta
+import time
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Paths served without tenant context
+_SKIP_PATHS = frozenset({"/health", "/docs", "/openapi.json"})
+
+# Shared (Redis) API key cache and the channel API_KEY_INVALIDATION_SCHEMA notifies on
+_REDIS_KEY_PREFIX = "apik:"
+_REDIS_NEGATIVE = b"0"
+_INVALIDATION_CHANNEL = "apikey_invalidation"
+# SQLAlchemy asyncpg dialect URL options that asyncpg.connect() would reject
+_DIALECT_ONLY_QUERY_PARAMS = ("prepared_statement_cache_size", "async_fallback")
+
+_LOOKUP_API_KEY_SQL = text("""
+    SELECT k.tenant_id, k.store_id, k.key_hash
+    FROM store_api_keys k
+    JOIN tenants t ON k.tenant_id = t.tenant_id
+    WHERE k.key_hash IN (:key_hash, :legacy_key_hash)
+    AND k.is_active = TRUE
+    AND t.is_active = TRUE
+""")
+_UPGRADE_API_KEY_HASH_SQL = text("UPDATE store_api_keys SET key_hash = :key_hash WHERE key_hash = :legacy_key_hash")
+_UPDATE_LAST_USED_SQL = text("""
+    UPDATE store_api_keys k
+    SET last_used_at = to_timestamp(v.used_at)
+    FROM unnest(CAST(:key_hashes AS text[]), CAST(:used_at AS float8[])) AS v(key_hash, used_at)
+    WHERE k.key_hash = v.key_hash
+""")
+_SET_TENANT_CONTEXT_SQL = text("SELECT set_config('app.tenant_id', :tenant_id, false)")
+_RESET_TENANT_CONTEXT_SQL = text("SELECT set_config('app.tenant_id', '', false)")
+_TENANT_STORE_LIMIT_SQL = text("""
+    SELECT t.max_stores,
+           (SELECT COUNT(*) FROM stores s
+            WHERE s.tenant_id = t.tenant_id AND s.is_active = TRUE) as store_count
+    FROM tenants t
+    WHERE t.tenant_id = :tenant_id AND t.is_active = TRUE
+""")
+_TENANT_COST_USAGE_SQL = text("""
+    SELECT t.max_monthly_cost, t.billing_email,
+           (SELECT COUNT(*) FROM metrics m
+            WHERE m.tenant_id = t.tenant_id
+            AND m.created_at > NOW() - INTERVAL '7 days') as weekly_events
+    FROM tenants t
+    WHERE t.tenant_id = :tenant_id
+""")
+
+class ApiKeyUsageFlusher:
+    """
+    Batches last_used_at writes for API keys.
+    
+    Shared by AuthService and TenantContextMiddleware so both record the
+    actual use time and a key's last_used_at never moves backwards.
+    """
+    
+    def __init__(self, flush_interval: int = 30):
+        self.flush_interval = flush_interval  # seconds
+        # key hash -> last use (epoch seconds)
+        self._pending: dict[str, float] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+    
+    def touch(self, key_hash: str):
+        """Record a use of the key, starts the flusher on first use (needs a running loop)"""
+        self._pending[key_hash] = time.time()
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+    
+    async def close(self):
+        """Stop the flusher and write any pending updates"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        
+        await self.flush()
+    
+    async def _flush_loop(self):
+        """Periodically write last_used_at for recently used API keys"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+    
+    async def flush(self):
+        """Write last_used_at for all pending API keys in one statement"""
+        if not self._pending:
+            return
+        
+        # Swap the dict so keys used during the flush land in the next batch
+        pending, self._pending = self._pending, {}
+        
+        from .database import get_database
+        
+        try:
+            async with get_database() as db:
+                await db.execute(_UPDATE_LAST_USED_SQL, {
+                    "key_hashes": list(pending.keys()),
+                    "used_at": list(pending.values())
+                })
+                await db.commit()
+        except Exception as e:
+            logger.warning(f"Failed to flush last_used_at for {len(pending)} API keys: {e}")
+            for key_hash, used_at in pending.items():
+                if used_at > self._pending.get(key_hash, 0):
+                    self._pending[key_hash] = used_at
+
+
+# Process-wide flusher (see ApiKeyUsageFlusher)
+api_key_usage = ApiKeyUsageFlusher()
+
+
 class TenantContextMiddleware:
     """
     Middleware para manejar contexto multi-tenant automáticamente.
@@ -23,41 +138,85 @@ class TenantContextMiddleware:
     - Cache de API keys para performance
     """
     
-    def __init__(self):
-        self.api_key_cache = {}  # Simple in-memory cache
+    # Live instances, so admin endpoints can invalidate keys (see invalidate_cached_api_key)
+    _instances: "weakref.WeakSet[TenantContextMiddleware]" = weakref.WeakSet()
+    
+    def __init__(self, redis_url: Optional[str] = None, database_url: Optional[str] = None):
+        # LRU of key hash -> (tenant_id, store_id, monotonic expiry),
+        # unknown keys are cached as (None, None, expiry) for a shorter time
+        self.api_key_cache: OrderedDict[str, tuple[Optional[str], Optional[str], float]] = OrderedDict()
         self.cache_ttl = 300  # 5 minutes
+        self.negative_cache_ttl = 30  # seconds
+        self.max_cache = 10_000
+        # Lookups in progress, concurrent misses for one key share a single query
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._started = False
+        # tenant_id -> monotonic time of the last limits check, at most one per interval
+        self.limits_check_interval = 300  # 5 minutes
+        self._limits_checked: dict[str, float] = {}
+        self._bg_tasks: set[asyncio.Task] = set()
+        # Optional Redis cache shared by all workers, behind the in-process LRU.
+        # Shorter TTL than L1: notifications missed while the listener is
+        # disconnected only clear L1, Redis entries then age out within this window
+        self.redis: Optional[aioredis.Redis] = aioredis.from_url(redis_url) if redis_url else None
+        self.redis_cache_ttl = 60  # seconds
+        # Keys invalidated while their lookup was in flight, the result must not be cached
+        self._invalidated_inflight: set[str] = set()
+        # Optional LISTEN connection that drops revoked keys from both caches
+        self._listen_dsn: Optional[str] = (
+            make_url(database_url)
+            .set(drivername="postgresql")
+            .difference_update_query(_DIALECT_ONLY_QUERY_PARAMS)
+            .render_as_string(hide_password=False)
+            if database_url else None
+        )
+        self._listen_task: Optional[asyncio.Task] = None
+        TenantContextMiddleware._instances.add(self)
         
     async def __call__(self, request: Request, call_next):
         # Skip tenant context for health checks
-        if request.url.path in ["/health", "/docs", "/openapi.json"]:
+        if request.url.path in _SKIP_PATHS:
             return await call_next(request)
+        
+        if not self._started:
+            self.start()
             
+        from .database import get_database
+        
         try:
-            # Extract and validate API key
-            tenant_id, store_id = await self._extract_tenant_context(request)
-            
-            if not tenant_id:
-                return JSONResponse(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    content={"detail": "Invalid or missing API key"}
-                )
-            
-            # Set request context
-            request.state.tenant_id = tenant_id
-            request.state.store_id = store_id
-            
-            # Set database tenant context for RLS
-            await self._set_database_context(tenant_id)
-            
-            # Validate tenant limits (async, don't block request)
-            asyncio.create_task(self._validate_tenant_limits(tenant_id))
-            
-            response = await call_next(request)
-            
-            # Log tenant activity
-            await self._log_tenant_activity(tenant_id, store_id, request)
-            
-            return response
+            # One session for auth, RLS context and the handler (see get_db)
+            async with get_database() as db:
+                request.state.db = db
+                
+                # Extract and validate API key
+                tenant_id, store_id = await self._extract_tenant_context(request, db)
+                
+                if not tenant_id:
+                    return JSONResponse(
+                        status_code=status.HTTP_401_UNAUTHORIZED,
+                        content={"detail": "Invalid or missing API key"}
+                    )
+                
+                # Set request context
+                request.state.tenant_id = tenant_id
+                request.state.store_id = store_id
+                
+                try:
+                    # Set database tenant context for RLS
+                    await self._set_database_context(tenant_id, db)
+                    
+                    # Validate tenant limits (async, don't block request)
+                    self._schedule_limits_check(tenant_id)
+                    
+                    response = await call_next(request)
+                    
+                    # Log tenant activity
+                    self._log_tenant_activity(tenant_id, store_id, request)
+                    
+                    return response
+                finally:
+                    # The GUC is session-level, clear it before the pooled connection is reused
+                    await self._reset_database_context(db)
             
         except HTTPException:
             raise
@@ -68,75 +227,216 @@ class TenantContextMiddleware:
                 content={"detail": "Internal server error"}
             )
     
-    async def _extract_tenant_context(self, request: Request) -> tuple[Optional[str], Optional[str]]:
+    async def _extract_tenant_context(self, request: Request, db) -> tuple[Optional[str], Optional[str]]:
         """Extract tenant_id and store_id from API key"""
         
         # Get API key from Authorization header
-        auth_header = request.headers.get("Authorization", "")
-        if not auth_header.startswith("Bearer "):
+        auth_header = request.headers.get("Authorization")
+        if not auth_header or not auth_header.startswith("Bearer "):
             return None, None
             
-        api_key = auth_header.replace("Bearer ", "")
+        api_key = auth_header[7:]
         if not api_key:
             return None, None
         
-        # Check cache first
-        cache_key = hashlib.sha256(api_key.encode()).hexdigest()
+        # Check cache first, the hash doubles as the lookup key below
+        cache_key = hash_api_key(api_key)
         cached_result = self.api_key_cache.get(cache_key)
         
-        if cached_result and cached_result['expires'] > datetime.utcnow():
-            return cached_result['tenant_id'], cached_result['store_id']
+        if cached_result and cached_result[2] > time.monotonic():
+            self.api_key_cache.move_to_end(cache_key)
+            if cached_result[0]:
+                api_key_usage.touch(cache_key)
+            return cached_result[0], cached_result[1]
         
-        # Database lookup
-        tenant_id, store_id = await self._lookup_api_key(api_key)
+        # Another request is already looking this key up, wait for its result
+        while (inflight := self._inflight.get(cache_key)) is not None:
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                # The request running the lookup was cancelled, not this one: retry
+                if not inflight.cancelled():
+                    raise
         
-        # Cache result
-        if tenant_id:
-            self.api_key_cache[cache_key] = {
-                'tenant_id': tenant_id,
-                'store_id': store_id,
-                'expires': datetime.utcnow() + timedelta(seconds=self.cache_ttl)
-            }
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[cache_key] = future
+        try:
+            # Shared cache, then database
+            tenant_id, store_id = await self._resolve_api_key(api_key, cache_key, db)
+            
+            # Cache result, misses too so invalid keys don't hit the database every time.
+            # Skipped when the key was invalidated mid-lookup (the result may predate a revoke)
+            if cache_key in self._invalidated_inflight:
+                self._invalidated_inflight.discard(cache_key)
+            else:
+                ttl = self.cache_ttl if tenant_id else self.negative_cache_ttl
+                self.api_key_cache[cache_key] = (tenant_id, store_id, time.monotonic() + ttl)
+                self.api_key_cache.move_to_end(cache_key)
+                while len(self.api_key_cache) > self.max_cache:
+                    self.api_key_cache.popitem(last=False)
+            
+            if tenant_id:
+                api_key_usage.touch(cache_key)
+            
+            future.set_result((tenant_id, store_id))
+            return tenant_id, store_id
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # retrieved here, waiters (if any) re-raise it
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+            del self._inflight[cache_key]
+            self._invalidated_inflight.discard(cache_key)
+    
+    async def _resolve_api_key(self, api_key: str, key_hash: str, db) -> tuple[Optional[str], Optional[str]]:
+        """Resolve an API key through Redis (when configured) and the database"""
+        if self.redis is None:
+            return await self._lookup_api_key(api_key, key_hash, db)
+        
+        redis_key = _REDIS_KEY_PREFIX + key_hash
+        try:
+            cached = await self.redis.get(redis_key)
+        except Exception as e:
+            logger.warning(f"Redis API key cache read failed: {e}")
+            cached = None
+        
+        if cached == _REDIS_NEGATIVE:
+            return None, None
+        if cached is not None:
+            tenant_id, store_id = orjson.loads(cached)
+            return tenant_id, store_id
+        
+        tenant_id, store_id = await self._lookup_api_key(api_key, key_hash, db)
+        
+        # nx: never overwrite an entry written meanwhile, in particular the
+        # tombstone invalidate() leaves when a key is revoked during this lookup
+        try:
+            if tenant_id:
+                await self.redis.set(
+                    redis_key, orjson.dumps([tenant_id, store_id]), ex=self.redis_cache_ttl, nx=True
+                )
+            else:
+                await self.redis.set(redis_key, _REDIS_NEGATIVE, ex=self.negative_cache_ttl, nx=True)
+        except Exception as e:
+            logger.warning(f"Redis API key cache write failed: {e}")
         
         return tenant_id, store_id
     
-    async def _lookup_api_key(self, api_key: str) -> tuple[Optional[str], Optional[str]]:
-        """Lookup API key in database"""
-        from .database import get_database
+    async def _lookup_api_key(self, api_key: str, key_hash: str, db) -> tuple[Optional[str], Optional[str]]:
+        """Lookup API key in database (key_hash is hash_api_key(api_key), already computed)"""
         
-        key_hash = hashlib.sha256(api_key.encode()).hexdigest()
+        # Keys issued before the BLAKE2b switch are stored as SHA-256
+        result = await db.execute(_LOOKUP_API_KEY_SQL, {
+            "key_hash": key_hash,
+            "legacy_key_hash": legacy_api_key_hash(api_key)
+        })
+        row = result.fetchone()
         
-        async with get_database() as db:
-            query = text("""
-                SELECT k.tenant_id, k.store_id 
-                FROM store_api_keys k
-                JOIN tenants t ON k.tenant_id = t.tenant_id
-                WHERE k.key_hash = :key_hash 
-                AND k.is_active = TRUE 
-                AND t.is_active = TRUE
-            """)
-            
-            result = await db.execute(query, {"key_hash": key_hash})
-            row = result.fetchone()
+        if row:
+            # Upgrade legacy hash in place, last_used_at is written by the flusher
+            if row.key_hash != key_hash:
+                await upgrade_legacy_api_key_hash(db, key_hash, row.key_hash)
             
-            if row:
-                # Update last_used_at
-                await db.execute(
-                    text("UPDATE store_api_keys SET last_used_at = NOW() WHERE key_hash = :key_hash"),
-                    {"key_hash": key_hash}
-                )
-                await db.commit()
-                
-                return row.tenant_id, row.store_id
-            
-            return None, None
+            return row.tenant_id, row.store_id
+        
+        return None, None
+    
+    def start(self):
+        """Start the invalidation listener (requires a running event loop)"""
+        self._started = True
+        if self._listen_task is None and self._listen_dsn:
+            self._listen_task = asyncio.create_task(self._listen_invalidations())
     
-    async def _set_database_context(self, tenant_id: str):
+    async def close(self):
+        """Stop the listener and write any pending last_used_at updates"""
+        if self._listen_task is not None:
+            self._listen_task.cancel()
+            try:
+                await self._listen_task
+            except asyncio.CancelledError:
+                pass
+            self._listen_task = None
+        self._started = False
+        
+        await api_key_usage.close()
+        
+        if self.redis is not None:
+            await self.redis.aclose()
+    
+    async def _listen_invalidations(self):
+        """Keep a LISTEN connection open and drop keys the database reports as changed"""
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(self._listen_dsn)
+                await conn.add_listener(_INVALIDATION_CHANNEL, self._on_key_invalidated)
+                # Notifications sent while disconnected are lost: start from a clean L1,
+                # Redis entries for missed revocations expire within redis_cache_ttl
+                self.api_key_cache.clear()
+                while not conn.is_closed():
+                    await asyncio.sleep(30)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"API key invalidation listener failed: {e}")
+            finally:
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+            await asyncio.sleep(5)
+    
+    def invalidate(self, key_hash: str):
+        """Drop an API key from the local cache and tombstone it in Redis (after revocation or rotation)"""
+        self.api_key_cache.pop(key_hash, None)
+        if key_hash in self._inflight:
+            self._invalidated_inflight.add(key_hash)
+        if self.redis is not None:
+            # A tombstone rather than DEL, so a lookup that read the key before the
+            # revoke committed can't write it back (positive entries are set with nx)
+            task = asyncio.create_task(self.redis.set(
+                _REDIS_KEY_PREFIX + key_hash, _REDIS_NEGATIVE, ex=self.negative_cache_ttl
+            ))
+            self._bg_tasks.add(task)
+            task.add_done_callback(self._bg_tasks.discard)
+    
+    def _on_key_invalidated(self, connection, pid: int, channel: str, key_hash: str):
+        """asyncpg notification callback, payload is the changed key_hash"""
+        self.invalidate(key_hash)
+        
+        # Keys changed by another worker: drop them from AuthService's cache as well
+        from .auth import auth_service
+        if auth_service:
+            auth_service.invalidate_key(key_hash)
+    
+    async def _set_database_context(self, tenant_id: str, db):
         """Set tenant context for Row Level Security"""
-        from .database import get_database
+        # Bound parameter: no SQL injection, one statement text for every tenant
+        await db.execute(_SET_TENANT_CONTEXT_SQL, {"tenant_id": tenant_id})
+    
+    async def _reset_database_context(self, db):
+        """Clear the tenant context so the next borrower of the connection doesn't inherit it"""
+        try:
+            # Drop whatever the handler left uncommitted (closing the session would anyway)
+            # and commit the reset, or the close-time rollback would undo it too
+            await db.rollback()
+            await db.execute(_RESET_TENANT_CONTEXT_SQL)
+            await db.commit()
+        except Exception as e:
+            # Don't mask the request's own outcome; a broken connection is discarded by the pool
+            logger.warning(f"Failed to reset tenant context: {e}")
+    
+    def _schedule_limits_check(self, tenant_id: str):
+        """Run the tenant limits check in the background, once per tenant per interval"""
+        now = time.monotonic()
+        if self._limits_checked.get(tenant_id, 0) > now - self.limits_check_interval:
+            return
+        self._limits_checked[tenant_id] = now
         
-        async with get_database() as db:
-            await db.execute(text(f"SET app.tenant_id = '{tenant_id}'"))
+        # Keep a reference so the task isn't garbage collected while pending
+        task = asyncio.create_task(self._validate_tenant_limits(tenant_id))
+        self._bg_tasks.add(task)
+        task.add_done_callback(self._bg_tasks.discard)
     
     async def _validate_tenant_limits(self, tenant_id: str):
         """Validate tenant limits (async - don't block request)"""
@@ -149,22 +449,28 @@ class TenantContextMiddleware:
             await limits_service.validate_store_limit(tenant_id)
             
             # Check cost limit (hourly check)
-            current_hour = datetime.utcnow().hour
+            current_hour = time.gmtime().tm_hour
             if current_hour % 4 == 0:  # Check every 4 hours
                 await limits_service.check_cost_limit(tenant_id)
                 
         except Exception as e:
             logger.warning(f"Tenant limits validation failed for {tenant_id}: {e}")
     
-    async def _log_tenant_activity(self, tenant_id: str, store_id: str, request: Request):
-        """Log tenant activity for analytics"""
-        logger.info(f"Tenant activity", extra={
-            "tenant_id": tenant_id,
-            "store_id": store_id,
-            "method": request.method,
-            "path": request.url.path,
-            "timestamp": datetime.utcnow().isoformat()
-        })
+    def _log_tenant_activity(self, tenant_id: str, store_id: str, request: Request):
+        """Log tenant activity for analytics (timestamp comes from the log formatter)"""
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        method, path = request.method, request.url.path
+        logger.info(
+            "Tenant activity tenant=%s store=%s method=%s path=%s",
+            tenant_id, store_id, method, path,
+            extra={
+                "tenant_id": tenant_id,
+                "store_id": store_id,
+                "method": method,
+                "path": path
+            }
+        )
 
 
 class TenantLimitsService:
@@ -175,73 +481,43 @@ class TenantLimitsService:
         from .database import get_database
         
         async with get_database() as db:
-            # Get tenant limits
-            tenant_query = text("""
-                SELECT max_stores, max_monthly_cost 
-                FROM tenants 
-                WHERE tenant_id = :tenant_id AND is_active = TRUE
-            """)
-            tenant_result = await db.execute(tenant_query, {"tenant_id": tenant_id})
-            tenant = tenant_result.fetchone()
+            # Tenant limits and active store count in one round-trip
+            result = await db.execute(_TENANT_STORE_LIMIT_SQL, {"tenant_id": tenant_id})
+            tenant = result.fetchone()
             
             if not tenant:
                 raise HTTPException(404, f"Tenant {tenant_id} not found or inactive")
             
-            # Count active stores
-            stores_query = text("""
-                SELECT COUNT(*) as store_count 
-                FROM stores 
-                WHERE tenant_id = :tenant_id AND is_active = TRUE
-            """)
-            stores_result = await db.execute(stores_query, {"tenant_id": tenant_id})
-            store_count = stores_result.fetchone().store_count
-            
-            if store_count >= tenant.max_stores:
-                logger.warning(f"Store limit exceeded for tenant {tenant_id}: {store_count}/{tenant.max_stores}")
-                raise HTTPException(429, f"Store limit exceeded: {store_count}/{tenant.max_stores}")
+            if tenant.store_count >= tenant.max_stores:
+                logger.warning(f"Store limit exceeded for tenant {tenant_id}: {tenant.store_count}/{tenant.max_stores}")
+                raise HTTPException(429, f"Store limit exceeded: {tenant.store_count}/{tenant.max_stores}")
     
     async def check_cost_limit(self, tenant_id: str) -> float:
         """Check if tenant is approaching cost limits"""
         # TODO: Integrate with GCP Billing API
         # For now, return estimated cost based on usage
-        
-        estimated_monthly_cost = await self._estimate_monthly_cost(tenant_id)
-        
         from .database import get_database
+        
         async with get_database() as db:
-            tenant_query = text("""
-                SELECT max_monthly_cost, billing_email 
-                FROM tenants 
-                WHERE tenant_id = :tenant_id
-            """)
-            result = await db.execute(tenant_query, {"tenant_id": tenant_id})
+            # Cost limit, billing contact and last 7 days of events in one round-trip
+            result = await db.execute(_TENANT_COST_USAGE_SQL, {"tenant_id": tenant_id})
             tenant = result.fetchone()
             
+            if not tenant:
+                raise HTTPException(404, f"Tenant {tenant_id} not found")
+            
+            estimated_monthly_cost = self._estimate_monthly_cost(tenant.weekly_events)
+            
             if estimated_monthly_cost > tenant.max_monthly_cost * 0.8:  # 80% threshold
                 await self._send_cost_alert(tenant_id, estimated_monthly_cost, tenant.billing_email)
             
             return estimated_monthly_cost
     
-    async def _estimate_monthly_cost(self, tenant_id: str) -> float:
+    def _estimate_monthly_cost(self, weekly_events: int) -> float:
         """Estimate monthly cost based on current usage"""
-        from .database import get_database
-        
-        async with get_database() as db:
-            # Count events in last 7 days to project monthly
-            query = text("""
-                SELECT COUNT(*) as event_count
-                FROM metrics 
-                WHERE tenant_id = :tenant_id 
-                AND created_at > NOW() - INTERVAL '7 days'
-            """)
-            result = await db.execute(query, {"tenant_id": tenant_id})
-            weekly_events = result.fetchone().event_count
-            
-            # Simple cost estimation (events * cost_per_event * 4 weeks)
-            monthly_events = weekly_events * 4
-            estimated_cost = self._calculate_gcp_costs(monthly_events)
-            
-            return estimated_cost
+        # Simple cost estimation (events * cost_per_event * 4 weeks)
+        monthly_events = weekly_events * 4
+        return self._calculate_gcp_costs(monthly_events)
     
     def _calculate_gcp_costs(self, monthly_events: int) -> float:
         """Calculate estimated GCP costs based on events"""
@@ -264,6 +540,25 @@ class TenantLimitsService:
         pass
 
 
+# API key hashing
+def hash_api_key(api_key: str) -> str:
+    """Hash API key for storage and lookup (BLAKE2b-256, hex)"""
+    return hashlib.blake2b(api_key.encode(), digest_size=32).hexdigest()
+
+def legacy_api_key_hash(api_key: str) -> str:
+    """SHA-256 hash used for API keys issued before the BLAKE2b switch"""
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+async def upgrade_legacy_api_key_hash(db, key_hash: str, legacy_key_hash: str):
+    """Replace a stored SHA-256 key hash with its BLAKE2b hash and commit"""
+    await db.execute(_UPGRADE_API_KEY_HASH_SQL, {"key_hash": key_hash, "legacy_key_hash": legacy_key_hash})
+    await db.commit()
+
+def invalidate_cached_api_key(key_hash: str):
+    """Drop an API key from every middleware cache in this process"""
+    for middleware in list(TenantContextMiddleware._instances):
+        middleware.invalidate(key_hash)
+
 # FastAPI integration
 def get_tenant_id(request: Request) -> str:
     """Dependency to get current tenant_id"""
@@ -271,8 +566,45 @@ def get_tenant_id(request: Request) -> str:
         raise HTTPException(401, "No tenant context available")
     return request.state.tenant_id
 
+async def get_db(request: Request) -> AsyncIterator:
+    """Dependency yielding one database session shared by the whole request"""
+    db = getattr(request.state, "db", None)
+    if db is not None:
+        yield db
+        return
+    
+    from .database import get_database
+    
+    async with get_database() as db:
+        request.state.db = db
+        yield db
+
 def get_store_id(request: Request) -> str:
     """Dependency to get current store_id"""
     if not hasattr(request.state, 'store_id'):
         raise HTTPException(401, "No store context available")
-    return request.state.store_id
\ No newline at end of file
+    return request.state.store_id
+
+
+# Notify API workers when a key is revoked, re-hashed or deleted so cached
+# lookups are dropped fleet-wide (see TenantContextMiddleware._listen_invalidations)
+API_KEY_INVALIDATION_SCHEMA = """
+CREATE OR REPLACE FUNCTION notify_api_key_invalidation() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('apikey_invalidation', OLD.key_hash);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS api_key_invalidation_update ON store_api_keys;
+CREATE TRIGGER api_key_invalidation_update
+    AFTER UPDATE ON store_api_keys
+    FOR EACH ROW
+    WHEN (OLD.is_active IS DISTINCT FROM NEW.is_active OR OLD.key_hash IS DISTINCT FROM NEW.key_hash)
+    EXECUTE FUNCTION notify_api_key_invalidation();
+
+DROP TRIGGER IF EXISTS api_key_invalidation_delete ON store_api_keys;
+CREATE TRIGGER api_key_invalidation_delete
+    AFTER DELETE ON store_api_keys
+    FOR EACH ROW EXECUTE FUNCTION notify_api_key_invalidation();
+"""
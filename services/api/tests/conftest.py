@@ -0,0 +1,5 @@
+# Make the API modules importable as top-level modules in tests
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,55 @@
+# Tests for the orjson-backed JWT codec used by AuthService
+
+import time
+
+import jwt
+import pytest
+
+from jwt_codec import OrjsonJWT, JWT_DECODE_OPTIONS
+
+_KEY = b"test-secret"
+
+
+def _payload(**overrides):
+    # Same claims AuthService.create_access_token issues
+    now = int(time.time())
+    payload = {
+        "sub": "user1",
+        "tenant_id": "tenant1",
+        "user_type": "client",
+        "permissions": ["read_metrics"],
+        "exp": now + 3600,
+        "iat": now,
+        "iss": "storepulse-auth",
+    }
+    payload.update(overrides)
+    return payload
+
+
+def _decode(token):
+    return OrjsonJWT().decode(token, _KEY, algorithms=["HS256"], options=JWT_DECODE_OPTIONS)
+
+
+def test_encode_decode_round_trip():
+    payload = _payload()
+    token = OrjsonJWT().encode(payload, _KEY, algorithm="HS256")
+
+    assert _decode(token) == payload
+    # Interoperable with stock PyJWT
+    assert jwt.decode(token, _KEY, algorithms=["HS256"], options=JWT_DECODE_OPTIONS) == payload
+
+
+def test_expired_token_is_rejected():
+    token = OrjsonJWT().encode(_payload(exp=int(time.time()) - 10), _KEY, algorithm="HS256")
+
+    with pytest.raises(jwt.ExpiredSignatureError):
+        _decode(token)
+
+
+def test_token_without_tenant_id_is_rejected():
+    payload = _payload()
+    del payload["tenant_id"]
+    token = OrjsonJWT().encode(payload, _KEY, algorithm="HS256")
+
+    with pytest.raises(jwt.MissingRequiredClaimError):
+        _decode(token)
@@ -0,0 +1,65 @@
+# Tests for TenantContextMiddleware API key resolution
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from tenant_middleware import TenantContextMiddleware
+
+
+def _request(api_key: str):
+    return SimpleNamespace(headers={"Authorization": f"Bearer {api_key}"})
+
+
+@pytest.mark.asyncio
+async def test_waiter_retries_when_lookup_leader_is_cancelled():
+    middleware = TenantContextMiddleware()
+    leader_started = asyncio.Event()
+    calls = 0
+
+    async def resolve(api_key, key_hash, db):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            leader_started.set()
+            await asyncio.Event().wait()  # blocks until cancelled
+        return "tenant1", "T01"
+
+    middleware._resolve_api_key = resolve
+
+    leader = asyncio.create_task(middleware._extract_tenant_context(_request("key"), None))
+    await leader_started.wait()
+    waiter = asyncio.create_task(middleware._extract_tenant_context(_request("key"), None))
+    await asyncio.sleep(0)
+
+    leader.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await leader
+
+    assert await asyncio.wait_for(waiter, timeout=1) == ("tenant1", "T01")
+    assert calls == 2
+    assert not middleware._inflight
+
+
+@pytest.mark.asyncio
+async def test_key_invalidated_during_lookup_is_not_cached():
+    middleware = TenantContextMiddleware()
+    lookup_started = asyncio.Event()
+    release = asyncio.Event()
+
+    async def resolve(api_key, key_hash, db):
+        lookup_started.set()
+        await release.wait()
+        return "tenant1", "T01"
+
+    middleware._resolve_api_key = resolve
+
+    lookup = asyncio.create_task(middleware._extract_tenant_context(_request("key"), None))
+    await lookup_started.wait()
+    middleware.invalidate(next(iter(middleware._inflight)))
+    release.set()
+
+    assert await lookup == ("tenant1", "T01")
+    assert not middleware.api_key_cache
+    assert not middleware._invalidated_inflight
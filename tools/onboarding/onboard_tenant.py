@@ -20,8 +20,11 @@ import sys
 from pathlib import Path
 from datetime import datetime
 from typing import List, Dict
-import requests
+import httpx
+import yaml
 import os
+import base64
+from string import Template
 
 # Add parent directory to path for imports
 sys.path.append(str(Path(__file__).parent.parent))
@@ -31,12 +34,147 @@ from backend.api.tenant_management import (
     create_tenant, create_store, generate_api_key
 )
 
+# libyaml-backed dumper when available
+_YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+# Random bytes per API key (matches the API's key generation)
+API_KEY_BYTES = 32
+
+# Gateway deployment templates, parsed once and filled in per store
+_DOCKER_COMPOSE_TEMPLATE = Template("""version: '3.8'
+
+services:
+  gateway:
+    image: storepulse/gateway:latest
+    container_name: sp-gateway-${store_id_lower}
+    ports:
+      - "8080:8080"
+    volumes:
+      - ./data:/data
+    environment:
+      - GATEWAY_PORT=8080
+      - CLOUD_API_URL=https://ingest.storepulse.io
+      - API_KEY=${api_key}
+      - SQLITE_PATH=/data/buffer.db
+      - SYNC_INTERVAL_SECONDS=30
+      - BATCH_SIZE=50
+      - STORE_ID=${store_id}
+      - TENANT_ID=${tenant_id}
+      - LOG_LEVEL=INFO
+    restart: unless-stopped
+    logging:
+      driver: "json-file"
+      options:
+        max-size: "10m"
+        max-file: "3"
+    healthcheck:
+      test: ["CMD", "curl", "-f", "http://localhost:8080/health"]
+      interval: 30s
+      timeout: 5s
+      retries: 3
+      start_period: 10s
+
+  # Optional: POS Agent (if running on same server)
+  # pos-agent:
+  #   image: storepulse/pos-agent:latest
+  #   container_name: sp-agent-${store_id_lower}
+  #   volumes:
+  #     - ./pos-config:/config
+  #   environment:
+  #     - GATEWAY_URL=http://gateway:8080
+  #     - STORE_ID=${store_id}
+  #   depends_on:
+  #     - gateway
+  #   restart: unless-stopped
+""")
+
+_DEPLOY_SCRIPT_TEMPLATE = Template("""#!/bin/bash
+# StorePulse Gateway Deployment Script
+# Tenant: ${tenant_id}, Store: ${store_id}
+
+set -e
+
+echo "🚀 Deploying StorePulse Gateway for ${tenant_id}/${store_id}"
+
+# Check requirements
+if ! command -v docker &> /dev/null; then
+    echo "❌ Docker not installed. Installing..."
+    curl -fsSL https://get.docker.com -o get-docker.sh
+    sudo sh get-docker.sh
+    sudo systemctl enable docker
+    sudo systemctl start docker
+    sudo usermod -aG docker $$USER
+    echo "✅ Docker installed. Please re-login and run script again."
+    exit 0
+fi
+
+if ! command -v docker-compose &> /dev/null; then
+    echo "❌ Docker Compose not installed. Installing..."
+    sudo curl -L "https://github.com/docker/compose/releases/latest/download/docker-compose-$$(uname -s)-$$(uname -m)" -o /usr/local/bin/docker-compose
+    sudo chmod +x /usr/local/bin/docker-compose
+fi
+
+# Create project directory
+PROJECT_DIR="/opt/storepulse-${store_id_lower}"
+sudo mkdir -p $$PROJECT_DIR
+sudo mkdir -p $$PROJECT_DIR/data
+sudo chown -R $$USER:$$USER $$PROJECT_DIR
+cd $$PROJECT_DIR
+
+# Stop existing services
+if [ -f docker-compose.yml ]; then
+    echo "🔄 Stopping existing services..."
+    docker-compose down
+fi
+
+# Copy configuration files
+echo "📋 Setting up configuration..."
+# docker-compose.yml should be provided separately
+
+# Pull latest images
+echo "📥 Pulling latest images..."
+docker-compose pull
+
+# Start services
+echo "🚀 Starting services..."
+docker-compose up -d
+
+# Wait for services to be ready
+echo "⏳ Waiting for services to start..."
+sleep 15
+
+# Health check
+echo "🏥 Checking service health..."
+if curl -f http://localhost:8080/health; then
+    echo "✅ Gateway is healthy!"
+    echo "🎉 Deployment completed successfully!"
+    echo ""
+    echo "📊 Service Status:"
+    docker-compose ps
+    echo ""
+    echo "📝 Logs: docker-compose logs -f"
+    echo "🔄 Restart: docker-compose restart"
+    echo "🛑 Stop: docker-compose down"
+else
+    echo "❌ Gateway health check failed!"
+    echo "📋 Checking logs..."
+    docker-compose logs
+    exit 1
+fi
+""")
+
 class TenantOnboarder:
     """Automated tenant onboarding service"""
     
     def __init__(self, api_base_url: str = "http://localhost:8080"):
         self.api_base_url = api_base_url
-        self.session = requests.Session()
+        # Async client so API calls don't block the event loop; keep-alive across stores
+        self.client = httpx.AsyncClient(
+            base_url=api_base_url,
+            timeout=10,
+            limits=httpx.Limits(max_keepalive_connections=20)
+        )
+        self.max_concurrency = 10  # stores provisioned in parallel
         
     async def onboard_tenant(
         self, 
@@ -80,28 +218,41 @@ class TenantOnboarder:
             
             # Step 2: Create stores
             print(f"\n🏪 Step 2: Creating {store_count} stores...")
-            for i in range(1, store_count + 1):
-                store_id = f"T{i:02d}"  # T01, T02, T03, ...
-                store_name = f"{company_name} - Tienda {store_id}"
-                
-                store_data = await self._create_store(tenant_id, store_id, store_name)
+            # Stores are independent, provision them concurrently (bounded)
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+            
+            async def bounded(coro):
+                async with semaphore:
+                    return await coro
+            
+            # Random material for every store's API key, read in one call
+            key_material = os.urandom(API_KEY_BYTES * store_count)
+            
+            store_ids = [f"T{i:02d}" for i in range(1, store_count + 1)]  # T01, T02, T03, ...
+            store_names = [f"{company_name} - Tienda {store_id}" for store_id in store_ids]
+            
+            provisioned = await asyncio.gather(*(
+                bounded(self._provision_store(
+                    tenant_id,
+                    store_id,
+                    store_name,
+                    key_material[i * API_KEY_BYTES:(i + 1) * API_KEY_BYTES]
+                ))
+                for i, (store_id, store_name) in enumerate(zip(store_ids, store_names))
+            ))
+            
+            # gather keeps submission order, so stores stay T01, T02, ...
+            for store_data, api_key_data, deployment_config in provisioned:
                 results["stores"].append(store_data)
-                print(f"  ✅ Store created: {store_id} ({store_name})")
-                
-                # Step 3: Generate API key for each store
-                api_key_data = await self._generate_api_key(tenant_id, store_id)
                 results["api_keys"].append(api_key_data)
-                print(f"  🔑 API key generated: {api_key_data['key_id']}")
-                
-                # Step 4: Create deployment config
-                deployment_config = self._create_deployment_config(
-                    tenant_id, store_id, store_name, api_key_data['api_key']
-                )
                 results["deployment_configs"].append(deployment_config)
             
+            # Serialized once, written both into the package and next to it
+            results_json = json.dumps(results, indent=2, default=str)
+            
             # Step 5: Generate deployment package
             print(f"\n📦 Step 3: Generating deployment package...")
-            package_path = await self._create_deployment_package(results)
+            package_path = await self._create_deployment_package(results, results_json)
             print(f"✅ Deployment package created: {package_path}")
             
             # Step 6: Validation
@@ -113,8 +264,7 @@ class TenantOnboarder:
             print(f"📄 Results saved to: onboarding_results_{tenant_id}.json")
             
             # Save results
-            with open(f"onboarding_results_{tenant_id}.json", "w") as f:
-                json.dump(results, f, indent=2, default=str)
+            Path(f"onboarding_results_{tenant_id}.json").write_text(results_json)
             
             return results
             
@@ -124,6 +274,26 @@ class TenantOnboarder:
             await self._cleanup_failed_onboarding(tenant_id)
             raise
     
+    async def aclose(self):
+        """Close the HTTP client"""
+        await self.client.aclose()
+    
+    async def _provision_store(self, tenant_id: str, store_id: str, store_name: str, key_bytes: bytes) -> tuple:
+        """Create one store, its API key and deployment config"""
+        store_data = await self._create_store(tenant_id, store_id, store_name)
+        print(f"  ✅ Store created: {store_id} ({store_name})")
+        
+        # Step 3: Generate API key for the store
+        api_key_data = await self._generate_api_key(tenant_id, store_id, key_bytes)
+        print(f"  🔑 API key generated: {api_key_data['key_id']}")
+        
+        # Step 4: Create deployment config
+        deployment_config = self._create_deployment_config(
+            tenant_id, store_id, store_name, api_key_data['api_key']
+        )
+        
+        return store_data, api_key_data, deployment_config
+    
     async def _create_tenant(self, **kwargs) -> Dict:
         """Create tenant via API"""
         tenant_data = TenantCreate(**kwargs)
@@ -150,11 +320,10 @@ class TenantOnboarder:
             "is_active": True
         }
     
-    async def _generate_api_key(self, tenant_id: str, store_id: str) -> Dict:
+    async def _generate_api_key(self, tenant_id: str, store_id: str, key_bytes: bytes) -> Dict:
         """Generate API key via API"""
-        import secrets
-        
-        api_key = f"store_{tenant_id}_{store_id}_{secrets.token_urlsafe(32)}"
+        # Same format the API issues: unpadded base64url, no tenant/store in the key
+        api_key = base64.urlsafe_b64encode(key_bytes).rstrip(b"=").decode()
         return {
             "key_id": f"store_{tenant_id}_{store_id}",
             "tenant_id": tenant_id,
@@ -194,130 +363,21 @@ class TenantOnboarder:
     def _generate_docker_compose(self, tenant_id: str, store_id: str, api_key: str) -> str:
         """Generate docker-compose.yml for store gateway"""
         
-        return f"""version: '3.8'
-
-services:
-  gateway:
-    image: storepulse/gateway:latest
-    container_name: sp-gateway-{store_id.lower()}
-    ports:
-      - "8080:8080"
-    volumes:
-      - ./data:/data
-    environment:
-      - GATEWAY_PORT=8080
-      - CLOUD_API_URL=https://ingest.storepulse.io
-      - API_KEY={api_key}
-      - SQLITE_PATH=/data/buffer.db
-      - SYNC_INTERVAL_SECONDS=30
-      - BATCH_SIZE=50
-      - STORE_ID={store_id}
-      - TENANT_ID={tenant_id}
-      - LOG_LEVEL=INFO
-    restart: unless-stopped
-    logging:
-      driver: "json-file"
-      options:
-        max-size: "10m"
-        max-file: "3"
-    healthcheck:
-      test: ["CMD", "curl", "-f", "http://localhost:8080/health"]
-      interval: 30s
-      timeout: 5s
-      retries: 3
-      start_period: 10s
-
-  # Optional: POS Agent (if running on same server)
-  # pos-agent:
-  #   image: storepulse/pos-agent:latest
-  #   container_name: sp-agent-{store_id.lower()}
-  #   volumes:
-  #     - ./pos-config:/config
-  #   environment:
-  #     - GATEWAY_URL=http://gateway:8080
-  #     - STORE_ID={store_id}
-  #   depends_on:
-  #     - gateway
-  #   restart: unless-stopped
-"""
+        return _DOCKER_COMPOSE_TEMPLATE.substitute(
+            tenant_id=tenant_id,
+            store_id=store_id,
+            store_id_lower=store_id.lower(),
+            api_key=api_key
+        )
     
     def _generate_deployment_script(self, tenant_id: str, store_id: str) -> str:
         """Generate deployment script for store"""
         
-        return f"""#!/bin/bash
-# StorePulse Gateway Deployment Script
-# Tenant: {tenant_id}, Store: {store_id}
-
-set -e
-
-echo "🚀 Deploying StorePulse Gateway for {tenant_id}/{store_id}"
-
-# Check requirements
-if ! command -v docker &> /dev/null; then
-    echo "❌ Docker not installed. Installing..."
-    curl -fsSL https://get.docker.com -o get-docker.sh
-    sudo sh get-docker.sh
-    sudo systemctl enable docker
-    sudo systemctl start docker
-    sudo usermod -aG docker $USER
-    echo "✅ Docker installed. Please re-login and run script again."
-    exit 0
-fi
-
-if ! command -v docker-compose &> /dev/null; then
-    echo "❌ Docker Compose not installed. Installing..."
-    sudo curl -L "https://github.com/docker/compose/releases/latest/download/docker-compose-$(uname -s)-$(uname -m)" -o /usr/local/bin/docker-compose
-    sudo chmod +x /usr/local/bin/docker-compose
-fi
-
-# Create project directory
-PROJECT_DIR="/opt/storepulse-{store_id.lower()}"
-sudo mkdir -p $PROJECT_DIR
-sudo mkdir -p $PROJECT_DIR/data
-sudo chown -R $USER:$USER $PROJECT_DIR
-cd $PROJECT_DIR
-
-# Stop existing services
-if [ -f docker-compose.yml ]; then
-    echo "🔄 Stopping existing services..."
-    docker-compose down
-fi
-
-# Copy configuration files
-echo "📋 Setting up configuration..."
-# docker-compose.yml should be provided separately
-
-# Pull latest images
-echo "📥 Pulling latest images..."
-docker-compose pull
-
-# Start services
-echo "🚀 Starting services..."
-docker-compose up -d
-
-# Wait for services to be ready
-echo "⏳ Waiting for services to start..."
-sleep 15
-
-# Health check
-echo "🏥 Checking service health..."
-if curl -f http://localhost:8080/health; then
-    echo "✅ Gateway is healthy!"
-    echo "🎉 Deployment completed successfully!"
-    echo ""
-    echo "📊 Service Status:"
-    docker-compose ps
-    echo ""
-    echo "📝 Logs: docker-compose logs -f"
-    echo "🔄 Restart: docker-compose restart"
-    echo "🛑 Stop: docker-compose down"
-else
-    echo "❌ Gateway health check failed!"
-    echo "📋 Checking logs..."
-    docker-compose logs
-    exit 1
-fi
-"""
+        return _DEPLOY_SCRIPT_TEMPLATE.substitute(
+            tenant_id=tenant_id,
+            store_id=store_id,
+            store_id_lower=store_id.lower()
+        )
     
     def _generate_pos_agent_config(self, store_id: str) -> Dict:
         """Generate POS agent configuration"""
@@ -340,7 +400,7 @@ fi
             }
         }
     
-    async def _create_deployment_package(self, results: Dict) -> str:
+    async def _create_deployment_package(self, results: Dict, results_json: str) -> str:
         """Create deployment package with all configs"""
         
         tenant_id = results["tenant_id"]
@@ -348,46 +408,42 @@ fi
         package_dir.mkdir(exist_ok=True)
         
         # Create README
-        readme_content = f"""# StorePulse Deployment Package
+        readme_parts = [f"""# StorePulse Deployment Package
 ## Tenant: {results['company_name']} ({tenant_id})
 ## Generated: {results['created_at']}
 
 ### Stores and API Keys:
-"""
+"""]
         
-        for i, store in enumerate(results["stores"]):
+        for store, api_key_data, deployment_config in zip(
+            results["stores"], results["api_keys"], results["deployment_configs"]
+        ):
             store_id = store["store_id"]
-            api_key = results["api_keys"][i]["api_key"]
             
-            readme_content += f"\n**{store_id}**: {store['store_name']}\n"
-            readme_content += f"API Key: `{api_key}`\n"
+            readme_parts.append(f"\n**{store_id}**: {store['store_name']}\nAPI Key: `{api_key_data['api_key']}`\n")
             
             # Create store-specific directory
             store_dir = package_dir / store_id
             store_dir.mkdir(exist_ok=True)
             
             # Write docker-compose.yml
-            with open(store_dir / "docker-compose.yml", "w") as f:
-                f.write(results["deployment_configs"][i]["docker_compose"])
+            (store_dir / "docker-compose.yml").write_text(deployment_config["docker_compose"])
             
             # Write deployment script
             script_path = store_dir / "deploy.sh"
-            with open(script_path, "w") as f:
-                f.write(results["deployment_configs"][i]["deployment_script"])
+            script_path.write_text(deployment_config["deployment_script"])
             script_path.chmod(0o755)  # Make executable
             
             # Write POS agent config
-            with open(store_dir / "pos-agent-config.yaml", "w") as f:
-                import yaml
-                yaml.dump(results["deployment_configs"][i]["pos_agent_config"], f)
+            (store_dir / "pos-agent-config.yaml").write_text(
+                yaml.dump(deployment_config["pos_agent_config"], Dumper=_YAML_DUMPER)
+            )
         
         # Write README
-        with open(package_dir / "README.md", "w") as f:
-            f.write(readme_content)
+        (package_dir / "README.md").write_text("".join(readme_parts))
         
         # Write complete results
-        with open(package_dir / "onboarding_results.json", "w") as f:
-            json.dump(results, f, indent=2, default=str)
+        (package_dir / "onboarding_results.json").write_text(results_json)
         
         return str(package_dir.absolute())
     
@@ -439,15 +495,18 @@ def main():
     async def run_onboarding():
         onboarder = TenantOnboarder(api_base_url=args.api_url)
         
-        results = await onboarder.onboard_tenant(
-            tenant_id=args.tenant_id,
-            company_name=args.company,
-            store_count=args.stores,
-            billing_email=args.email,
-            admin_contact=args.admin,
-            whatsapp_numbers=args.whatsapp or [],
-            max_monthly_cost=args.max_cost
-        )
+        try:
+            results = await onboarder.onboard_tenant(
+                tenant_id=args.tenant_id,
+                company_name=args.company,
+                store_count=args.stores,
+                billing_email=args.email,
+                admin_contact=args.admin,
+                whatsapp_numbers=args.whatsapp or [],
+                max_monthly_cost=args.max_cost
+            )
+        finally:
+            await onboarder.aclose()
         
         print(f"\n📊 Summary:")
         print(f"Tenant: {results['tenant_id']}")